@@ -1,23 +1,40 @@
-from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Header, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union
 import uuid
 from datetime import datetime, timezone
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import httpx
 import yt_dlp
+from yt_dlp.utils import DownloadCancelled
 import asyncio
+import contextvars
+import anyio
 import zipfile
+import io
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from contextlib import asynccontextmanager, contextmanager
+import threading
+import multiprocessing
+from multiprocessing.managers import BaseManager
+import queue
+import functools
+import subprocess
+from collections import OrderedDict, deque
 import re
+import json
+import math
+import time
+from urllib.parse import quote
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -33,12 +50,6 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
-# Spotify client
-spotify_client = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
-    client_id=os.environ.get('SPOTIFY_CLIENT_ID'),
-    client_secret=os.environ.get('SPOTIFY_CLIENT_SECRET')
-))
-
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -46,7 +57,28 @@ app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # Thread pool for async execution
-executor = ThreadPoolExecutor(max_workers=4)
+MAX_DOWNLOAD_WORKERS = int(os.environ.get('MAX_DOWNLOAD_WORKERS', '4'))
+executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS)
+
+# Track pipeline sizing: searches, network fetches (I/O bound) and ffmpeg transcodes (CPU bound)
+SEARCH_STAGE_WORKERS = int(os.environ.get('SEARCH_STAGE_WORKERS', str(MAX_DOWNLOAD_WORKERS)))
+DOWNLOAD_IO_WORKERS = int(os.environ.get('DOWNLOAD_IO_WORKERS', '8'))
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', str(os.cpu_count() or 1)))
+
+# 'thread' runs the track pipeline on in-process pools; 'process' runs download_from_youtube in worker processes
+DOWNLOAD_WORKER_MODE = os.environ.get('DOWNLOAD_WORKER_MODE', 'thread')
+PROCESS_WORKERS = int(os.environ.get('PROCESS_WORKERS', str(MAX_DOWNLOAD_WORKERS)))
+# Download worker processes re-import this module; they must not start pools or touch the cache
+DOWNLOAD_WORKER_PROCESS_NAME = 'download-worker'
+IN_DOWNLOAD_WORKER = multiprocessing.current_process().name == DOWNLOAD_WORKER_PROCESS_NAME
+
+# Concurrency limits for batch downloads: per job and across the whole server.
+# By default, as many tracks as can download at once. Interactive requests get slots
+# first, and the pipeline stages and YouTube limiters also serve them ahead of batch
+# tracks, so a single-track download doesn't queue behind a playlist anywhere.
+DOWNLOAD_CAPACITY = PROCESS_WORKERS if DOWNLOAD_WORKER_MODE == 'process' else DOWNLOAD_IO_WORKERS
+BATCH_CONCURRENCY_PER_JOB = int(os.environ.get('BATCH_CONCURRENCY_PER_JOB', str(DOWNLOAD_CAPACITY)))
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', str(DOWNLOAD_CAPACITY)))
 
 # Download directory
 DOWNLOAD_DIR = Path("/tmp/spotify_downloads")
@@ -71,15 +103,87 @@ class PlaylistResponse(BaseModel):
     image_url: Optional[str] = None
     total_tracks: int
     tracks: List[Track]
+    snapshot_id: Optional[str] = None  # Spotify's version of the playlist, changes with every edit
+
+# yt-dlp format selector and FFmpegExtractAudio codec per output format
+# (codec None = keep the stream exactly as YouTube serves it)
+OUTPUT_FORMATS = {
+    'native': ('bestaudio/best', None),
+    'm4a': ('bestaudio[ext=m4a]/bestaudio/best', 'm4a'),
+    'opus': ('bestaudio[acodec=opus]/bestaudio/best', 'opus'),
+    'mp3': ('bestaudio/best', 'mp3'),
+}
+
+AUDIO_MEDIA_TYPES = {
+    '.mp3': 'audio/mpeg',
+    '.m4a': 'audio/mp4',
+    '.opus': 'audio/ogg',
+    '.ogg': 'audio/ogg',
+    '.webm': 'audio/webm',
+}
+
+@dataclass(frozen=True)
+class AudioFormat:
+    name: str = 'mp3'
+    bitrate: int = 192  # only used for mp3
+    
+    @property
+    def selector(self) -> str:
+        return OUTPUT_FORMATS[self.name][0]
+    
+    @property
+    def codec(self) -> Optional[str]:
+        return OUTPUT_FORMATS[self.name][1]
+    
+    @property
+    def variant(self) -> str:
+        """Cache key part: the same video in another format is a different file"""
+        return f"mp3-{self.bitrate}" if self.name == 'mp3' else self.name
+
+DEFAULT_AUDIO_FORMAT = AudioFormat()
+
+class DownloadOptions(BaseModel):
+    # 'native' keeps YouTube's stream, 'm4a'/'opus' remux it when YouTube has that codec (and
+    # re-encode, with a warning, when it doesn't), 'mp3' re-encodes at `bitrate`
+    output_format: Literal['native', 'm4a', 'opus', 'mp3'] = 'mp3'
+    bitrate: int = Field(default=192, ge=64, le=320)
+    force_retry: bool = False  # try tracks again even if they recently failed (negative cache)
+    
+    def audio_format(self) -> AudioFormat:
+        return AudioFormat(self.output_format, self.bitrate)
 
-class DownloadRequest(BaseModel):
+class DownloadRequest(DownloadOptions):
     track_name: str
     track_artist: str
     track_id: str
 
-class DownloadAllRequest(BaseModel):
+class DownloadAllRequest(DownloadOptions):
     playlist_id: str
     tracks: List[Track]
+    max_concurrency: Optional[int] = Field(default=None, ge=1)  # capped by BATCH_CONCURRENCY_PER_JOB
+
+class SyncRequest(DownloadOptions):
+    playlist_id: str = Field(pattern=r'^[a-zA-Z0-9]+$')
+    # Separate sync state per client/device syncing the same playlist
+    sync_id: str = Field(default='default', pattern=r'^[\w\-]{1,64}$')
+    reset: bool = False  # forget what was delivered and send every track again
+    max_concurrency: Optional[int] = Field(default=None, ge=1)  # capped by BATCH_CONCURRENCY_PER_JOB
+
+class JobCreatedResponse(BaseModel):
+    job_id: str
+    status: str
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    playlist_id: str
+    status: str
+    total_tracks: int
+    completed_tracks: int
+    successful_downloads: int
+    failed_tracks: List[str]
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+    artifact_ready: bool
 
 def extract_playlist_id(url: str) -> str:
     """Extract Spotify playlist ID from URL"""
@@ -103,6 +207,10 @@ def clean_query(text: str) -> str:
     cleaned = ' '.join(cleaned.split())
     return cleaned
 
+def archive_name(audio_file: Path) -> str:
+    """Clean the filename - remove the unique prefix (track_####_uniqueid_)"""
+    return re.sub(r'^track_\d+_[a-f0-9]{8}_', '', audio_file.name)
+
 def extract_additional_keywords(track_name: str) -> list:
     """Extract genre, producer, remix type, and other identifying keywords from track name"""
     keywords = []
@@ -158,315 +266,2727 @@ def calculate_match_score(video_title: str, track_name: str, artist_name: str) -
     
     return score
 
-def download_from_youtube(query: str, output_path: Path, file_prefix: str = "", track_name: str = "", artist_name: str = "") -> bool:
-    """Download audio from YouTube and convert to MP3 with intelligent matching"""
+@dataclass
+class DownloadResult:
+    path: Path
+    video_id: str
+    filename: str  # file name without the unique prefix
+    strategy: str
+    score: Optional[float] = None  # None when the video was picked without matching
+    acodec: Optional[str] = None  # codec of the downloaded stream, as reported by yt-dlp
+
+@dataclass(frozen=True)
+class DownloadFailure:
+    """Why the track pipeline produced no audio for a track"""
+    reason: str  # 'not_found', 'throttled', 'error', 'timeout' or 'cancelled'
     
-    # Generate unique filename to avoid conflicts
-    unique_id = str(uuid.uuid4())[:8]
-    output_template = f"{file_prefix}_{unique_id}_%(title)s.%(ext)s" if file_prefix else f"{unique_id}_%(title)s.%(ext)s"
-    
-    base_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'outtmpl': str(output_path / output_template),
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': False,
-        'ignoreerrors': True,
-        'no_check_certificate': True,
-        'prefer_free_formats': True,
-        'age_limit': None,
-    }
+    @property
+    def permanent(self) -> bool:
+        """Only YouTube having no usable video says something about the track; the rest may work on a retry"""
+        return self.reason == 'not_found'
+
+class TrackDownloadError(Exception):
+    """A pipeline stage failed for a reason that says nothing about the track itself"""
+    
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class AudioCache:
+    """Size-bounded LRU cache of finished audio files on disk.
+    
+    Audio is stored content-addressed by YouTube video id and output variant
+    (objects/<video_id>.<variant>.<ext>) and Spotify track ids point at it
+    (tracks/<track_id>.<variant>.json). Files are published with
+    link/copy to a temp name plus os.replace, so readers never see partial files.
+    Recency is the object's mtime, bumped on every hit; once the total size goes over
+    max_bytes, the oldest objects are evicted down to LOW_WATER of it, so a full cache
+    is not rescanned on every publish.
+    Every method touches the disk: call them from a thread, not the event loop.
+    """
+    
+    _SAFE_KEY = re.compile(r'[\w\-]+')
+    # Fraction of max_bytes that eviction trims the cache down to
+    LOW_WATER = 0.9
+    
+    def __init__(self, root: Path, max_bytes: int):
+        self.objects_dir = root / "objects"
+        self.tracks_dir = root / "tracks"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tracks_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = 0
+    
+    def recover(self, stale_after: float):
+        """Drop temp files left by interrupted publishes and measure the cache.
+        
+        Other server processes may be publishing right now, so only temp files
+        older than stale_after seconds are removed. Age is the ctime: a hard-linked
+        temp file keeps the mtime of the download it came from.
+        """
+        cutoff = time.time() - stale_after
+        for tmp in [*self.objects_dir.glob(".*.tmp"), *self.tracks_dir.glob(".*.tmp")]:
+            try:
+                if tmp.stat().st_ctime < cutoff:
+                    tmp.unlink()
+            except OSError:
+                pass
+        size = 0
+        for path in self.objects_dir.glob("[!.]*"):
+            try:
+                size += path.stat().st_size
+            except OSError:
+                pass
+        with self._lock:
+            self._size = size
+    
+    def _valid(self, key: Optional[str]) -> bool:
+        return bool(key) and self._SAFE_KEY.fullmatch(key) is not None
+    
+    def _object_path(self, video_id: str, variant: str, ext: str) -> Path:
+        return self.objects_dir / f"{video_id}.{variant}{ext}"
+    
+    def _track_path(self, track_id: str, variant: str) -> Path:
+        return self.tracks_dir / f"{track_id}.{variant}.json"
+    
+    def lookup_video(self, video_id: str, variant: str) -> Optional[Path]:
+        """Return the cached audio of a YouTube video in a variant, marking it as recently used"""
+        if not self._valid(video_id):
+            return None
+        # The extension of 'native' audio depends on what YouTube served
+        for path in self.objects_dir.glob(f"{video_id}.{variant}.*"):
+            try:
+                os.utime(path)
+            except OSError:
+                continue
+            return path
+        return None
+    
+    def lookup(self, track_id: str, variant: str) -> Optional[Tuple[Path, str]]:
+        """Return (cached audio, original file name) for a Spotify track id"""
+        if not self._valid(track_id):
+            return None
+        try:
+            entry = json.loads(self._track_path(track_id, variant).read_text())
+        except (OSError, ValueError):
+            return None
+        path = self.lookup_video(entry.get('video_id'), variant)
+        if not path:
+            return None
+        return path, entry.get('filename') or path.name
+    
+    def publish(self, track_id: str, variant: str, result: DownloadResult):
+        """Store a finished download under its video id and point the track id at it"""
+        if not self._valid(result.video_id):
+            return
+        obj = self._object_path(result.video_id, variant, result.path.suffix)
+        if not obj.exists():
+            tmp = self.objects_dir / f".{uuid.uuid4().hex}.tmp"
+            try:
+                link_or_copy(result.path, tmp)
+                size = tmp.stat().st_size
+                os.replace(tmp, obj)
+            except OSError as e:
+                logging.warning(f"⚠ Falha ao salvar no cache: {e}")
+                tmp.unlink(missing_ok=True)
+                return
+            with self._lock:
+                self._size += size
+        
+        self.link_track(track_id, variant, result.video_id, result.filename)
+        self._evict()
+    
+    def link_track(self, track_id: str, variant: str, video_id: str, filename: str):
+        """Point a Spotify track id at the cached audio of a video"""
+        if not self._valid(track_id):
+            return
+        entry = {'video_id': video_id, 'filename': filename}
+        tmp = self.tracks_dir / f".{uuid.uuid4().hex}.tmp"
+        try:
+            tmp.write_text(json.dumps(entry))
+            os.replace(tmp, self._track_path(track_id, variant))
+        except OSError as e:
+            # The pointer only saves a later lookup: the download itself already succeeded
+            logging.warning(f"⚠ Falha ao salvar no cache: {e}")
+            tmp.unlink(missing_ok=True)
+    
+    def _evict(self):
+        with self._lock:
+            if self._size <= self.max_bytes:
+                return
+            entries = []
+            for path in self.objects_dir.glob("[!.]*"):
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+            self._size = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, path in entries:
+                if self._size <= self.max_bytes * self.LOW_WATER:
+                    break
+                try:
+                    # Open file handles (e.g. a FileResponse in progress) keep working after unlink
+                    path.unlink()
+                    self._size -= size
+                except OSError:
+                    pass
+        # Track pointers to evicted objects are dropped lazily: lookup() treats them as misses
+
+def link_or_copy(src: Path, dest: Path):
+    """Hard link src to dest, copying when linking is not possible (e.g. across devices)"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+# On-disk audio cache shared by every request
+AUDIO_CACHE_DIR = Path(os.environ.get('AUDIO_CACHE_DIR', '/tmp/spotify_cache'))
+AUDIO_CACHE_MAX_MB = int(os.environ.get('AUDIO_CACHE_MAX_MB', '5120'))
+AUDIO_CACHE_STALE_TMP = float(os.environ.get('AUDIO_CACHE_STALE_TMP', '3600'))
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1024 * 1024)
+# Cache lookups, links and publishes: a link becomes a full copy when the cache is on another filesystem
+AUDIO_CACHE_IO_WORKERS = int(os.environ.get('AUDIO_CACHE_IO_WORKERS', '4'))
+cache_executor = ThreadPoolExecutor(max_workers=AUDIO_CACHE_IO_WORKERS, thread_name_prefix="audio-cache")
+
+class NegativeCache:
+    """Tracks that recently could not be found or downloaded, failed fast until their entry expires.
+    
+    Entries are keyed by Spotify track id and by cleaned search query, so the same song
+    under another track id (e.g. a single and its album version) is skipped too.
+    Only touched from the event loop, so no locking.
+    """
+    
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._expiry: "OrderedDict[str, float]" = OrderedDict()
+    
+    def _keys(self, track_id: str, query: str) -> List[str]:
+        return [f"track:{track_id}", f"query:{clean_query(query).lower()}"]
+    
+    def contains(self, track_id: str, query: str) -> bool:
+        now = time.monotonic()
+        for key in self._keys(track_id, query):
+            expires = self._expiry.get(key)
+            if expires is None:
+                continue
+            if expires > now:
+                return True
+            del self._expiry[key]
+        return False
+    
+    def add(self, track_id: str, query: str):
+        if self.ttl <= 0:
+            return
+        expires = time.monotonic() + self.ttl
+        for key in self._keys(track_id, query):
+            self._expiry[key] = expires
+            self._expiry.move_to_end(key)
+        # Oldest entries go first once full
+        while len(self._expiry) > self.max_entries:
+            self._expiry.popitem(last=False)
+    
+    def discard(self, track_id: str, query: str):
+        for key in self._keys(track_id, query):
+            self._expiry.pop(key, None)
+
+# How long a track that could not be downloaded is failed fast (0 disables the negative cache)
+NEGATIVE_CACHE_TTL = float(os.environ.get('NEGATIVE_CACHE_TTL', '3600'))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', '10000'))
+unresolvable_tracks = NegativeCache(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_MAX_ENTRIES)
+
+# A candidate scoring at least this much ends the search phase early
+SEARCH_MATCH_THRESHOLD = float(os.environ.get('SEARCH_MATCH_THRESHOLD', '40'))
+# Start the next search in parallel when the current one takes longer than this (0 = serial)
+SEARCH_HEDGE_DELAY = float(os.environ.get('SEARCH_HEDGE_DELAY', '4'))
+# Threads for (possibly hedged) searches, separate from the download workers that wait on them
+SEARCH_WORKERS = int(os.environ.get('SEARCH_WORKERS', str(MAX_DOWNLOAD_WORKERS * 3)))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+# How many of the ranked candidates to try downloading before giving up
+MAX_CANDIDATE_ATTEMPTS = int(os.environ.get('MAX_CANDIDATE_ATTEMPTS', '3'))
+# Seconds one track may spend searching, downloading and converting (0 = no limit)
+TRACK_TIME_BUDGET = float(os.environ.get('TRACK_TIME_BUDGET', '300'))
+# Share of the budget reserved for each phase, in pipeline order
+TRACK_BUDGET_PHASES = (('search', 0.25), ('download', 0.55), ('transcode', 0.20))
+# How often a running ffmpeg conversion is checked against its budget and for cancellation
+TRANSCODE_POLL_INTERVAL = 1.0
+# yt-dlp gives up on a connection that stays silent this long, instead of hanging the worker
+YTDL_SOCKET_TIMEOUT = float(os.environ.get('YTDL_SOCKET_TIMEOUT', '20'))
+
+class TrackBudgetExceeded(DownloadCancelled):
+    msg = 'Orçamento de tempo da música esgotado'
+
+@dataclass(frozen=True)
+class TrackBudget:
+    """Time budget of one track, split across its search, download and transcode phases.
+    
+    A phase may run until the track's deadline minus the shares reserved for the phases
+    after it, so time an early phase leaves unused carries over to the next ones.
+    The deadline is a time.monotonic() value, so it holds in worker processes too.
+    """
+    deadline: float
+    total: float
+    
+    @classmethod
+    def start(cls, total: float = TRACK_TIME_BUDGET) -> 'TrackBudget':
+        if total <= 0:
+            return cls(math.inf, math.inf)
+        return cls(time.monotonic() + total, total)
     
+    def remaining(self, phase: Optional[str] = None) -> float:
+        """Seconds left for `phase` (or for the whole track), never negative"""
+        deadline = self.deadline
+        if phase and deadline != math.inf:
+            names = [name for name, _ in TRACK_BUDGET_PHASES]
+            reserved = sum(share for _, share in TRACK_BUDGET_PHASES[names.index(phase) + 1:])
+            deadline -= reserved * self.total
+        return max(deadline - time.monotonic(), 0.0)
+    
+    def exhausted(self, phase: Optional[str] = None) -> bool:
+        return self.remaining(phase) <= 0
+
+class AdaptiveLimiter:
+    """Paces one kind of outbound request with a token bucket and an AIMD concurrency limit.
+    
+    Each request takes a token (refilled at `rate` per second, up to `burst`; rate 0
+    disables the bucket) and an in-flight slot. The concurrency limit grows by about one
+    per round of successful requests and is cut by AIMD_DECREASE on an error or throttle,
+    at most once per round: requests started before the last cut don't cut it again.
+    A throttle also empties the bucket and pauses it for `backoff` seconds.
+    Batch requests wait while an interactive one does, so after a cut the freed slots
+    and tokens go to interactive work first.
+    Thread-safe, since requests are made from the worker threads.
+    """
+    
+    def __init__(self, name: str, rate: float, burst: int, max_limit: int, backoff: float):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_limit = max(max_limit, 1)
+        self.backoff = backoff
+        # Start at the ceiling, which matches the download slots: while YouTube is happy,
+        # a track holding a slot never waits here behind other tracks
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.interactive_waiting = 0
+        self.counts = {'ok': 0, 'error': 0, 'throttle': 0}
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._last_cut = 0.0
+        self._cond = threading.Condition()
+    
+    def _take_token(self, now: float) -> float:
+        """Take a token if one is available, otherwise return the seconds until there is one"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.rate <= 0:
+            return 0.0
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+    
+    def acquire(self, timeout: Optional[float] = None, interactive: bool = True) -> bool:
+        """Wait for a token and an in-flight slot; False if `timeout` seconds pass first"""
+        deadline = time.monotonic() + timeout if timeout is not None and timeout != math.inf else None
+        with self._cond:
+            if interactive:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = None  # no slot (or an interactive request goes first): wait for a release
+                    if self.in_flight < int(self.limit) and (interactive or not self.interactive_waiting):
+                        delay = self._take_token(now)
+                        if delay == 0:
+                            self.in_flight += 1
+                            return True
+                    if deadline is not None:
+                        if now >= deadline:
+                            return False
+                        delay = min(delay, deadline - now) if delay is not None else deadline - now
+                    self._cond.wait(delay)
+            finally:
+                if interactive:
+                    self.interactive_waiting -= 1
+                    if not self.interactive_waiting:
+                        self._cond.notify_all()  # batch requests may go again
+    
+    def release(self, outcome: Optional[str], started: float):
+        """Give the slot back; outcome is 'ok', 'error', 'throttle' or None (says nothing about YouTube)"""
+        with self._cond:
+            self.in_flight -= 1
+            if outcome:
+                self.counts[outcome] += 1
+            if outcome == 'ok':
+                self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+            elif outcome in ('error', 'throttle'):
+                now = time.monotonic()
+                if outcome == 'throttle':
+                    self._paused_until = max(self._paused_until, now + self.backoff)
+                    self._tokens = 0.0
+                    self._refilled = self._paused_until
+                if started >= self._last_cut:
+                    self._last_cut = now
+                    self.limit = max(self.limit * AIMD_DECREASE, 1.0)
+                    logging.warning(f"🐢 YouTube ({self.name}): {outcome}, limite reduzido para {int(self.limit)} simultâneas")
+            self._cond.notify_all()
+    
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'interactive_waiting': self.interactive_waiting,
+                'paused_seconds': round(max(self._paused_until - time.monotonic(), 0.0), 1),
+                **self.counts,
+            }
+
+# Requests per second and burst for each kind of YouTube request (rate 0 = unpaced)
+YOUTUBE_SEARCH_RATE = float(os.environ.get('YOUTUBE_SEARCH_RATE', '5'))
+YOUTUBE_SEARCH_BURST = int(os.environ.get('YOUTUBE_SEARCH_BURST', '10'))
+YOUTUBE_MEDIA_RATE = float(os.environ.get('YOUTUBE_MEDIA_RATE', '2'))
+YOUTUBE_MEDIA_BURST = int(os.environ.get('YOUTUBE_MEDIA_BURST', '5'))
+# How long to stop sending requests of a kind after YouTube throttles one
+YOUTUBE_THROTTLE_BACKOFF = float(os.environ.get('YOUTUBE_THROTTLE_BACKOFF', '30'))
+# Factor the concurrency limit is multiplied by on an error or throttle
+AIMD_DECREASE = 0.5
+
+# Shared by every job in this process; in process mode the workers use them over LimiterManager
+youtube_limiters = {
+    'search': AdaptiveLimiter('search', YOUTUBE_SEARCH_RATE, YOUTUBE_SEARCH_BURST, SEARCH_WORKERS,
+                              YOUTUBE_THROTTLE_BACKOFF),
+    'media': AdaptiveLimiter('media', YOUTUBE_MEDIA_RATE, YOUTUBE_MEDIA_BURST, DOWNLOAD_IO_WORKERS,
+                             YOUTUBE_THROTTLE_BACKOFF),
+}
+
+YOUTUBE_THROTTLE_ERRORS = re.compile(r"HTTP Error 429|Too Many Requests|rate.?limit|confirm you.?re not a bot", re.I)
+YOUTUBE_TRANSIENT_ERRORS = re.compile(
+    r"timed? ?out|HTTP Error (403|5\d\d)|Connection (reset|refused|aborted)|Temporary failure|Unable to download", re.I
+)
+
+YOUTUBE_FAILURE_REASONS = {'throttle': 'throttled', 'error': 'error'}
+
+def classify_youtube_errors(messages: List[str]) -> str:
+    """How YouTube answered a request, from its error messages: 'ok', 'error' or 'throttle'.
+    
+    Errors about the video itself (unavailable, private...) are answers too, so they count as 'ok'.
+    """
+    if any(YOUTUBE_THROTTLE_ERRORS.search(m) for m in messages):
+        return 'throttle'
+    if any(YOUTUBE_TRANSIENT_ERRORS.search(m) for m in messages):
+        return 'error'
+    return 'ok'
+
+class YtdlErrorLog:
+    """yt-dlp logger that keeps the errors of the current call (ignoreerrors swallows them otherwise)"""
+    
+    def __init__(self):
+        self.errors: List[str] = []
+    
+    def debug(self, msg: str):
+        pass
+    
+    def info(self, msg: str):
+        pass
+    
+    def warning(self, msg: str):
+        pass
+    
+    def error(self, msg: str):
+        self.errors.append(msg)
+        logging.error(msg)
+
+@contextmanager
+def youtube_request(kind: str, ydl: yt_dlp.YoutubeDL, timeout: Optional[float] = None) -> Iterator[None]:
+    """Make one yt-dlp request under the `kind` limiter and report how YouTube answered it.
+    
+    Raises TrackBudgetExceeded if no slot frees up within `timeout` seconds, and
+    TrackDownloadError when YouTube throttled or failed the request.
+    """
+    limiter = youtube_limiters[kind]
+    if not limiter.acquire(timeout, is_interactive(work_ticket.get())):
+        raise TrackBudgetExceeded()
+    error_log = ydl.params['logger']
+    error_log.errors.clear()
+    started = time.monotonic()
+    outcome = None
+    try:
+        yield
+        outcome = classify_youtube_errors(error_log.errors)
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        outcome = classify_youtube_errors([*error_log.errors, str(e)])
+        if outcome != 'ok':
+            raise TrackDownloadError(YOUTUBE_FAILURE_REASONS[outcome]) from e
+        raise
+    finally:
+        limiter.release(outcome, started)
+    if outcome != 'ok':
+        # ignoreerrors hid it: without this, a refused request would look like a missing video
+        raise TrackDownloadError(YOUTUBE_FAILURE_REASONS[outcome])
+
+def build_search_queries(query: str, track_name: str = "") -> List[Tuple[str, str]]:
+    """Build the distinct YouTube searches for a track as (search_query, strategy_name), most specific first"""
     # Extract additional keywords from track name for better search
     additional_keywords = extract_additional_keywords(track_name) if track_name else []
     keywords_str = ' '.join(additional_keywords[:2])  # Use top 2 keywords
     
     cleaned_query = clean_query(query)
     
-    # Build optimized search strategies
     queries_to_try = []
     
     # Strategy 1: If we have keywords, use them (most specific)
     if keywords_str and keywords_str.strip():
-        queries_to_try.append((f'ytsearch5:{cleaned_query} {keywords_str}', 'com palavras-chave específicas', True))
+        queries_to_try.append((f'ytsearch5:{cleaned_query} {keywords_str}', 'com palavras-chave específicas'))
     
-    # Strategy 2: Main strategy - cleaned query with intelligent matching
-    queries_to_try.append((f'ytsearch5:{cleaned_query}', 'busca principal', True))
+    # Strategy 2: Main strategy - cleaned query
+    # (also covers the old "busca simples", a ytsearch3 of the very same text)
+    queries_to_try.append((f'ytsearch5:{cleaned_query}', 'busca principal'))
     
     # Strategy 3: Fallback with "official" keyword
-    queries_to_try.append((f'ytsearch3:{cleaned_query} official', 'com "official"', False))
+    queries_to_try.append((f'ytsearch3:{cleaned_query} official', 'com "official"'))
+    
+    # Drop searches whose text repeats an earlier one (e.g. no keywords were found)
+    seen = set()
+    distinct = []
+    for search_query, strategy_name in queries_to_try:
+        text = search_query.split(':', 1)[1].strip().lower()
+        if text not in seen:
+            seen.add(text)
+            distinct.append((search_query, strategy_name))
+    return distinct
+
+class YoutubeDLPool:
+    """Warm YoutubeDL instances, kept per worker thread and per option profile.
     
-    # Strategy 4: Last resort - simple search
-    queries_to_try.append((f'ytsearch3:{cleaned_query}', 'busca simples', False))
+    Building a YoutubeDL registers every extractor, processes the options and opens a
+    new HTTP session, so instances are reused across searches and downloads. The output
+    template and the progress/postprocessor hooks change per call; hooks are installed
+    once as dispatchers that forward to whatever the current call passed in. Instances
+    are recycled after YDL_POOL_MAX_USES calls to keep long-lived state in check.
+    """
     
-    for search_query, strategy_name, use_matching in queries_to_try:
-        try:
-            opts = base_opts.copy()
-            opts['default_search'] = search_query.split(':')[0] + ':'
-            
-            logging.info(f"[{strategy_name}] Query: {search_query}")
-            
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                # Extract info first to check if videos are available
-                info = ydl.extract_info(search_query, download=False)
-                
-                if info and 'entries' in info and info['entries']:
-                    # Filter out unavailable videos
-                    available_videos = [v for v in info['entries'] if v is not None]
-                    
-                    if available_videos:
-                        # If we have track/artist info, use intelligent matching (only on first 2 strategies)
-                        if use_matching and track_name and artist_name:
-                            # Score only first 5 videos for speed
-                            best_score = -999
-                            best_video = None
-                            
-                            for video in available_videos[:5]:
-                                video_title = video.get('title', '')
-                                score = calculate_match_score(video_title, track_name, artist_name)
-                                
-                                if score > best_score:
-                                    best_score = score
-                                    best_video = video
-                            
-                            # Use best match if score is positive, otherwise use first video
-                            if best_score > 0 and best_video:
-                                logging.info(f"✓ Match: '{best_video.get('title')}' (score: {best_score:.1f})")
-                                video_url = best_video['webpage_url']
-                            else:
-                                logging.info(f"→ Sem match forte, usando primeiro resultado")
-                                video_url = available_videos[0]['webpage_url']
-                        else:
-                            # Fallback: use first available
-                            video_url = available_videos[0]['webpage_url']
-                            logging.info(f"→ Usando primeiro resultado disponível")
-                        
-                        # Download the selected video
-                        ydl.download([video_url])
-                        
-                        # Check if file was actually created
-                        mp3_files = list(output_path.glob("*.mp3"))
-                        if mp3_files:
-                            logging.info(f"✅ Download concluído com sucesso!")
-                            return True
-                        else:
-                            logging.warning(f"⚠ Arquivo MP3 não foi criado")
-                    else:
-                        logging.warning(f"⚠ Nenhum vídeo disponível")
-                else:
-                    logging.warning(f"⚠ Nenhum resultado encontrado")
-                    
-        except Exception as e:
-            logging.error(f"❌ Erro na estratégia '{strategy_name}': {str(e)}")
-            continue
+    def __init__(self, max_uses: int):
+        self.max_uses = max_uses
+        self._local = threading.local()
     
-    logging.error(f"❌ Todas as estratégias falharam para: {query}")
-    return False
-
-@api_router.get("/")
-async def root():
-    return {"message": "Spotify Playlist Downloader API"}
-
-@api_router.post("/playlist", response_model=PlaylistResponse)
-async def get_playlist(request: PlaylistRequest):
-    """Get playlist information from Spotify"""
-    try:
-        # Extract playlist ID
-        playlist_id = extract_playlist_id(request.url)
+    def _create(self, opts: dict) -> dict:
+        slot = {'progress': None, 'postprocess': None, 'uses': 0}
         
-        # Get playlist from Spotify with market parameter
-        playlist = spotify_client.playlist(playlist_id, market='BR')
-        
-        # Extract tracks
-        tracks = []
-        for item in playlist['tracks']['items']:
-            if item['track'] and item['track']['id']:  # Check if track exists and has ID
-                track = item['track']
-                tracks.append(Track(
-                    id=track['id'],
-                    name=track['name'],
-                    artist=', '.join([artist['name'] for artist in track['artists']]),
-                    album=track['album']['name'],
-                    image_url=track['album']['images'][0]['url'] if track['album']['images'] else None,
-                    duration_ms=track['duration_ms']
-                ))
+        def dispatch_progress(d):
+            if slot['progress']:
+                slot['progress'](d)
         
-        if not tracks:
-            raise HTTPException(status_code=400, detail="Esta playlist está vazia ou não possui músicas disponíveis.")
+        def dispatch_postprocess(d):
+            if slot['postprocess']:
+                slot['postprocess'](d)
         
-        return PlaylistResponse(
-            id=playlist['id'],
-            name=playlist['name'],
-            description=playlist.get('description'),
-            image_url=playlist['images'][0]['url'] if playlist['images'] else None,
-            total_tracks=len(tracks),
-            tracks=tracks
-        )
+        ydl = yt_dlp.YoutubeDL({**opts, 'progress_hooks': [dispatch_progress], 'logger': YtdlErrorLog()})
+        # Added after init: passing it in the options registers it twice on each postprocessor
+        ydl.add_postprocessor_hook(dispatch_postprocess)
+        slot['ydl'] = ydl
+        return slot
     
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
-    except HTTPException:
-        raise
-    except Exception as e:
-        error_msg = str(e)
-        logging.error(f"Error fetching playlist: {error_msg}")
+    @contextmanager
+    def acquire(self, opts: dict, outtmpl: Optional[str] = None,
+                progress_hook: Optional[Callable[[dict], None]] = None,
+                postprocessor_hook: Optional[Callable[[dict], None]] = None) -> Iterator[yt_dlp.YoutubeDL]:
+        instances = self._local.__dict__.setdefault('instances', {})
+        key = json.dumps(opts, sort_keys=True, default=str)
+        slot = instances.get(key)
+        if slot is None or slot['uses'] >= self.max_uses:
+            if slot is not None:
+                slot['ydl'].close()
+            slot = instances[key] = self._create(opts)
         
-        # Check for specific error types
-        if '404' in error_msg:
-            raise HTTPException(
-                status_code=404, 
-                detail="Playlist não encontrada. Verifique se a URL está correta e se a playlist é pública. Nota: algumas playlists geradas pelo Spotify podem ter restrições regionais."
-            )
-        elif '401' in error_msg or '403' in error_msg:
-            raise HTTPException(status_code=403, detail="Acesso negado. A playlist pode ser privada.")
-        else:
-            raise HTTPException(status_code=500, detail="Erro ao buscar playlist. Tente novamente.")
+        ydl = slot['ydl']
+        slot['uses'] += 1
+        slot['progress'] = progress_hook
+        slot['postprocess'] = postprocessor_hook
+        default_outtmpl = ydl.params['outtmpl']['default']
+        if outtmpl:
+            ydl.params['outtmpl']['default'] = outtmpl
+        try:
+            yield ydl
+        finally:
+            ydl.params['outtmpl']['default'] = default_outtmpl
+            slot['progress'] = slot['postprocess'] = None
 
-@api_router.post("/download-track")
-async def download_track(request: DownloadRequest, background_tasks: BackgroundTasks):
-    """Download a single track"""
-    try:
-        # Create unique directory for this download
-        download_id = str(uuid.uuid4())
-        track_dir = DOWNLOAD_DIR / download_id
-        track_dir.mkdir(exist_ok=True)
-        
-        # Search query
-        query = f"{request.track_name} {request.track_artist}"
-        
-        # Download in background with track name and artist for intelligent matching
-        loop = asyncio.get_event_loop()
-        success = await loop.run_in_executor(
-            executor,
-            download_from_youtube,
-            query,
-            track_dir,
-            "",  # file_prefix
-            request.track_name,  # track_name for matching
-            request.track_artist  # artist_name for matching
-        )
-        
-        if not success:
-            # Cleanup
-            try:
-                shutil.rmtree(track_dir)
-            except:
-                pass
-            raise HTTPException(
-                status_code=404, 
-                detail=f"Não foi possível encontrar/baixar '{request.track_name}' no YouTube. A música pode estar bloqueada ou indisponível."
-            )
-        
-        # Find the downloaded file
-        mp3_files = list(track_dir.glob("*.mp3"))
-        if not mp3_files:
-            # Cleanup
-            try:
-                shutil.rmtree(track_dir)
-            except:
-                pass
-            raise HTTPException(
-                status_code=404, 
-                detail=f"Arquivo não encontrado após download. A música '{request.track_name}' pode não estar disponível."
-            )
+YDL_POOL_MAX_USES = int(os.environ.get('YDL_POOL_MAX_USES', '200'))
+ydl_pool = YoutubeDLPool(YDL_POOL_MAX_USES)
+
+def run_search(search_opts: dict, search_query: str, strategy_name: str, timeout: Optional[float] = None) -> List[dict]:
+    """Run one flat YouTube search and return its entries"""
+    logging.info(f"[{strategy_name}] Query: {search_query}")
+    # Instances are per thread, so hedged searches running side by side never share one
+    with ydl_pool.acquire(search_opts) as search_ydl, youtube_request('search', search_ydl, timeout):
+        info = search_ydl.extract_info(search_query, download=False)
+    return (info or {}).get('entries') or []
+
+def search_candidates(search_opts: dict, queries: List[Tuple[str, str]], track_name: str = "", artist_name: str = "",
+                      progress_callback: Optional[Callable[[dict], None]] = None,
+                      budget: Optional[TrackBudget] = None) -> List[dict]:
+    """Run the searches once each and return the deduplicated candidates, best first.
+    
+    Candidates are keyed by video id and scored with calculate_match_score. Searches are
+    hedged: when one has not returned after SEARCH_HEDGE_DELAY seconds, the next one starts
+    in parallel (0 disables hedging). Searching stops as soon as some candidate reaches
+    SEARCH_MATCH_THRESHOLD, and searches still queued are cancelled. Searching also stops
+    when the budget's search phase runs out, keeping whatever was found so far.
+    Candidates with a positive score come first (highest first), followed by the rest
+    in search order. If nothing was found but some search failed (throttled, timed out...)
+    TrackDownloadError is raised, as the track may still exist.
+    """
+    budget = budget or TrackBudget.start()
+    use_matching = bool(track_name and artist_name)
+    pool: Dict[str, dict] = {}
+    pending = {}
+    next_idx = 0
+    failure = None
+    
+    def start_next():
+        nonlocal next_idx
+        search_query, strategy_name = queries[next_idx]
+        if progress_callback:
+            progress_callback({'status': 'searching', 'strategy': strategy_name})
+        # The searches pace themselves by the same ticket as the track
+        future = search_executor.submit(contextvars.copy_context().run, run_search, search_opts, search_query,
+                                        strategy_name, budget.remaining('search'))
+        pending[future] = (next_idx, strategy_name)
+        next_idx += 1
+    
+    def found_match() -> bool:
+        if not use_matching:
+            return bool(pool)
+        return any(c['score'] >= SEARCH_MATCH_THRESHOLD for c in pool.values())
+    
+    while pending or next_idx < len(queries):
+        remaining = budget.remaining('search')
+        if remaining <= 0:
+            logging.warning(f"⏱ Tempo de busca esgotado, seguindo com {len(pool)} resultados")
+            for future in pending:
+                future.cancel()
+            failure = failure or 'timeout'
+            break
+        if not pending:
+            start_next()
         
-        file_path = mp3_files[0]
+        hedge = SEARCH_HEDGE_DELAY > 0 and next_idx < len(queries)
+        timeout = min(SEARCH_HEDGE_DELAY, remaining) if hedge else remaining
+        done, _ = wait(pending, timeout=None if timeout == math.inf else timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            if hedge and not budget.exhausted('search'):
+                # Slow search: start the next strategy alongside it
+                logging.info(f"⏱ Busca lenta, iniciando próxima estratégia em paralelo")
+                start_next()
+            continue
         
-        # Schedule cleanup
-        def cleanup():
+        for future in done:
+            query_idx, strategy_name = pending.pop(future)
             try:
-                shutil.rmtree(track_dir)
-            except:
-                pass
-        
-        background_tasks.add_task(cleanup)
+                entries = future.result()
+            except Exception as e:
+                logging.error(f"❌ Erro na estratégia '{strategy_name}': {str(e)}")
+                if isinstance(e, TrackDownloadError):
+                    failure = failure or e.reason
+                elif isinstance(e, TrackBudgetExceeded):
+                    failure = failure or 'timeout'
+                else:
+                    failure = failure or 'error'
+                continue
+            
+            for rank, video in enumerate(entries):
+                if not video or not video.get('id') or video['id'] in pool:
+                    continue
+                score = calculate_match_score(video.get('title') or '', track_name, artist_name) if use_matching else None
+                pool[video['id']] = {'video': video, 'strategy': strategy_name, 'score': score, 'order': (query_idx, rank)}
         
-        return FileResponse(
-            path=file_path,
-            filename=f"{request.track_name} - {request.track_artist}.mp3",
-            media_type="audio/mpeg"
-        )
+        if found_match():
+            # Searches already running can't be interrupted; their results are simply ignored
+            for future in pending:
+                future.cancel()
+            break
     
-    except HTTPException:
-        raise
+    matched = sorted((c for c in pool.values() if c['score'] is not None and c['score'] > 0),
+                     key=lambda c: (-c['score'], c['order']))
+    # Penalized results (covers, karaoke...) go to the very end
+    others = sorted((c for c in pool.values() if c['score'] is None or c['score'] <= 0),
+                    key=lambda c: (c['score'] is not None and c['score'] < 0, c['order']))
+    if not pool and failure:
+        raise TrackDownloadError(failure)
+    return matched + others
+
+def video_page_url(entry: dict) -> str:
+    """Watch URL of a (possibly flat) search result"""
+    return entry.get('webpage_url') or entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}"
+
+# Spotify track -> YouTube video matches, shared by every worker through MongoDB
+track_resolutions = db.track_resolutions
+RESOLUTION_DB_TIMEOUT = float(os.environ.get('RESOLUTION_DB_TIMEOUT', '2'))
+# After a failure, skip the index for a while instead of paying the timeout on every track
+RESOLUTION_DB_RETRY_AFTER = 60
+_resolution_db_down_until = 0.0
+
+async def get_resolution(track_id: str) -> Optional[dict]:
+    """Look up the YouTube video previously matched to a Spotify track"""
+    global _resolution_db_down_until
+    if time.monotonic() < _resolution_db_down_until:
+        return None
+    try:
+        return await asyncio.wait_for(
+            track_resolutions.find_one({'track_id': track_id}, {'_id': 0}),
+            RESOLUTION_DB_TIMEOUT
+        )
     except Exception as e:
-        logging.error(f"Error downloading track: {e}")
-        raise HTTPException(status_code=500, detail="Erro ao processar download")
+        # The index is an optimization: fall back to searching if Mongo is unavailable
+        logging.warning(f"⚠ Falha ao consultar resolução de {track_id}: {e!r}")
+        _resolution_db_down_until = time.monotonic() + RESOLUTION_DB_RETRY_AFTER
+        return None
 
-@api_router.post("/download-all")
-async def download_all(request: DownloadAllRequest, background_tasks: BackgroundTasks):
-    """Download all tracks and create a ZIP file"""
+async def save_resolution(track_id: str, result: DownloadResult):
+    """Remember which YouTube video was chosen for a Spotify track"""
+    if time.monotonic() < _resolution_db_down_until:
+        return
     try:
-        # Create unique directory for this download
-        download_id = str(uuid.uuid4())
-        zip_dir = DOWNLOAD_DIR / download_id
-        zip_dir.mkdir(exist_ok=True)
-        
-        loop = asyncio.get_event_loop()
-        
-        successful_downloads = 0
-        failed_tracks = []
-        
-        # Download all tracks (continue even if some fail)
-        for idx, track in enumerate(request.tracks):
+        await asyncio.wait_for(
+            track_resolutions.update_one(
+                {'track_id': track_id},
+                {'$set': {
+                    'track_id': track_id,
+                    'video_id': result.video_id,
+                    'score': result.score,
+                    'strategy': result.strategy,
+                    'resolved_at': datetime.now(timezone.utc),
+                }},
+                upsert=True
+            ),
+            RESOLUTION_DB_TIMEOUT
+        )
+    except Exception as e:
+        logging.warning(f"⚠ Falha ao salvar resolução de {track_id}: {e!r}")
+
+# yt-dlp options for the search stage: flat metadata (id, title, duration) only
+SEARCH_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': True,
+    'ignoreerrors': True,
+    'no_check_certificate': True,
+    'socket_timeout': YTDL_SOCKET_TIMEOUT,
+}
+
+# yt-dlp options for the fetch stage: the best audio stream as-is, converted later
+# ('format' is replaced by the selector of the requested AudioFormat)
+FETCH_OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': False,
+    'ignoreerrors': True,
+    'no_check_certificate': True,
+    'prefer_free_formats': True,
+    'age_limit': None,
+    'socket_timeout': YTDL_SOCKET_TIMEOUT,
+}
+
+def search_youtube(query: str, track_name: str = "", artist_name: str = "",
+                   progress_callback: Optional[Callable[[dict], None]] = None,
+                   budget: Optional[TrackBudget] = None) -> List[dict]:
+    """Search stage: find and rank the YouTube candidates for a track"""
+    queries_to_try = build_search_queries(query, track_name)
+    candidates = search_candidates(SEARCH_OPTS, queries_to_try, track_name, artist_name, progress_callback, budget)
+    if not candidates:
+        logging.warning(f"⚠ Nenhum resultado encontrado")
+    return candidates[:MAX_CANDIDATE_ATTEMPTS]
+
+def resolved_candidate(video_id: str) -> dict:
+    """A candidate for a video already known from the resolution index"""
+    return {'video': {'id': video_id}, 'strategy': 'resolução salva', 'score': None}
+
+def log_candidate(candidate: dict):
+    video = candidate['video']
+    if candidate['strategy'] == 'resolução salva':
+        logging.info(f"[resolução salva] Vídeo: {video['id']}")
+    elif candidate['score'] is not None and candidate['score'] > 0:
+        logging.info(f"✓ Match [{candidate['strategy']}]: '{video.get('title')}' (score: {candidate['score']:.1f})")
+    else:
+        logging.info(f"→ Sem match forte, usando '{video.get('title')}' [{candidate['strategy']}]")
+
+def fetch_audio(candidates: List[dict], output_path: Path, name_prefix: str,
+                progress_callback: Optional[Callable[[dict], None]] = None,
+                audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT,
+                budget: Optional[TrackBudget] = None) -> Optional[DownloadResult]:
+    """Fetch stage: download the audio stream of the first candidate that works, without converting it.
+    
+    A download still running when the budget's download phase ends is aborted from the
+    progress hook, and no further candidates are tried. Returns None when every candidate
+    is unavailable; if some failed for other reasons (throttling, time, errors) it raises
+    TrackDownloadError instead, since the track may still be downloadable.
+    """
+    budget = budget or TrackBudget.start()
+    failure = None
+    
+    def on_progress(d):
+        if budget.exhausted('download'):
+            raise TrackBudgetExceeded()
+        if progress_callback and d.get('status') == 'downloading':
+            progress_callback({
+                'status': 'downloading',
+                'downloaded_bytes': d.get('downloaded_bytes'),
+                'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate'),
+            })
+    
+    outtmpl = str(output_path / f"{name_prefix}%(title)s.%(ext)s")
+    # Prefer a stream already in the target container so the transcode stage can just remux it
+    fetch_opts = {**FETCH_OPTS, 'format': audio_format.selector}
+    with ydl_pool.acquire(fetch_opts, outtmpl=outtmpl, progress_hook=on_progress) as ydl:
+        # Try the candidates in order; a failed download does not cost another search
+        for candidate in candidates:
+            video = candidate['video']
+            if budget.exhausted('download'):
+                logging.warning(f"⏱ Tempo de download esgotado, desistindo dos candidatos restantes")
+                failure = 'timeout'
+                break
             try:
-                query = f"{track.name} {track.artist}"
-                # Pass unique prefix to avoid file overwrites
-                file_prefix = f"track_{idx:03d}"
-                success = await loop.run_in_executor(
-                    executor,
-                    download_from_youtube,
-                    query,
-                    zip_dir,
-                    file_prefix,
-                    track.name,  # track_name for matching
-                    track.artist  # artist_name for matching
-                )
-                if success:
-                    successful_downloads += 1
-                    logging.info(f"✓ Baixado com sucesso [{idx+1}/{len(request.tracks)}]: {track.name}")
-                else:
-                    failed_tracks.append(track.name)
-                    logging.warning(f"✗ Falha ao baixar [{idx+1}/{len(request.tracks)}]: {track.name}")
+                log_candidate(candidate)
+                
+                # Full extraction (formats) happens only here, for the chosen video
+                with youtube_request('media', ydl, budget.remaining('download')):
+                    info = ydl.extract_info(video_page_url(video), download=True)
+                
+                downloads = (info or {}).get('requested_downloads') or []
+                path = Path(downloads[0]['filepath']) if downloads and downloads[0].get('filepath') else None
+                if path and path.exists():
+                    return DownloadResult(
+                        path=path,
+                        video_id=video['id'],
+                        filename=path.name[len(name_prefix):],
+                        strategy=candidate['strategy'],
+                        score=candidate['score'],
+                        acodec=downloads[0].get('acodec') or info.get('acodec'),
+                    )
+                logging.warning(f"⚠ Arquivo de áudio não foi criado")
+            except TrackBudgetExceeded:
+                logging.warning(f"⏱ Tempo de download esgotado: '{video.get('title') or video['id']}'")
+                failure = 'timeout'
+                break
+            except DownloadCancelled:
+                raise
             except Exception as e:
-                logging.error(f"Failed to download {track.name}: {e}")
-                failed_tracks.append(track.name)
-        
-        # Check if we have any downloads
-        mp3_files = list(zip_dir.glob("*.mp3"))
-        if not mp3_files:
-            # Cleanup
+                logging.error(f"❌ Erro ao baixar '{video.get('title') or video['id']}': {str(e)}")
+                failure = failure or (e.reason if isinstance(e, TrackDownloadError) else 'error')
+    if failure:
+        raise TrackDownloadError(failure)
+    return None
+
+def transcode_audio(result: DownloadResult, name_prefix: str,
+                    progress_callback: Optional[Callable[[dict], None]] = None,
+                    audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT,
+                    budget: Optional[TrackBudget] = None) -> DownloadResult:
+    """Transcode stage: convert a fetched audio stream to the requested format with ffmpeg.
+    
+    Only 'mp3' re-encodes; 'm4a' and 'opus' copy the stream into the new container when
+    the source codec already matches, and 'native' keeps the file as downloaded.
+    ffmpeg is killed once the budget's transcode phase runs out, or when progress_callback
+    raises (cancellation). Raises TrackDownloadError if the conversion fails or times out.
+    """
+    if audio_format.codec is None:
+        logging.info(f"✅ Download concluído com sucesso!")
+        return result
+    budget = budget or TrackBudget.start()
+    output_args, ext = stream_output_args(audio_format, {'acodec': result.acodec, 'ext': result.path.suffix[1:]},
+                                          seekable=True)
+    # Written aside first: with a codec copy the output may have the input's name
+    partial_path = result.path.with_name(f"{result.path.stem}.part{ext}")
+    audio_path = result.path.with_suffix(ext)
+    process = subprocess.Popen(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+         '-i', str(result.path), '-vn', *output_args, str(partial_path)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    started = time.monotonic()
+    try:
+        while True:
+            remaining = budget.remaining('transcode')
+            if remaining <= 0:
+                logging.warning(f"⏱ Conversão passou do tempo: '{result.path.name}'")
+                raise TrackDownloadError('timeout')
+            if progress_callback:
+                progress_callback({'status': 'transcoding', 'elapsed': round(time.monotonic() - started, 1)})
             try:
-                shutil.rmtree(zip_dir)
-            except:
-                pass
-            raise HTTPException(
-                status_code=404,
-                detail="Nenhuma música pôde ser baixada. Todas as músicas podem estar bloqueadas ou indisponíveis no YouTube."
-            )
+                _, stderr = process.communicate(timeout=min(remaining, TRANSCODE_POLL_INTERVAL))
+                break
+            except subprocess.TimeoutExpired:
+                continue
+        if process.returncode != 0:
+            logging.error(f"❌ Erro ao converter '{result.path.name}': {stderr.decode(errors='replace').strip()}")
+            raise TrackDownloadError('error')
+        result.path.unlink(missing_ok=True)
+        partial_path.replace(audio_path)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            process.wait()
+        partial_path.unlink(missing_ok=True)
+        result.path.unlink(missing_ok=True)
+        raise
+    
+    logging.info(f"✅ Download concluído com sucesso!")
+    return DownloadResult(
+        path=audio_path,
+        video_id=result.video_id,
+        filename=audio_path.name[len(name_prefix):],
+        strategy=result.strategy,
+        score=result.score,
+        acodec=audio_format.codec,
+    )
+
+def download_from_youtube(query: str, output_path: Path, file_prefix: str = "", track_name: str = "", artist_name: str = "",
+                          progress_callback: Optional[Callable[[dict], None]] = None,
+                          resolved_video_id: Optional[str] = None,
+                          audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT,
+                          budget: Optional[TrackBudget] = None) -> Union[DownloadResult, DownloadFailure]:
+    """Download audio from YouTube and convert it to audio_format with intelligent matching.
+    
+    Runs the search, fetch and transcode stages back to back on the calling thread;
+    run_track_pipeline runs the same stages on their own worker pools.
+    Returns the downloaded file and the chosen video, or a DownloadFailure saying why not.
+    If given, progress_callback is called from the worker thread with events like
+    {'status': 'searching' | 'downloading' | 'transcoding', ...}.
+    A resolved_video_id (from the resolution index) is downloaded directly, skipping
+    the search strategies unless that download fails.
+    All stages share one TrackBudget (a new TRACK_TIME_BUDGET if none is given); a track
+    that runs out of it fails with reason 'timeout'.
+    """
+    budget = budget or TrackBudget.start()
+    
+    # Generate unique filename to avoid conflicts
+    unique_id = str(uuid.uuid4())[:8]
+    name_prefix = f"{file_prefix}_{unique_id}_" if file_prefix else f"{unique_id}_"
+    
+    try:
+        fetched = None
+        # A previously matched video skips the search phase completely
+        if resolved_video_id:
+            fetched = fetch_audio([resolved_candidate(resolved_video_id)], output_path, name_prefix, progress_callback,
+                                  audio_format, budget)
+            if not fetched:
+                logging.warning(f"⚠ Vídeo salvo indisponível, buscando novamente")
         
-        # Create ZIP file
-        zip_path = DOWNLOAD_DIR / f"{download_id}.zip"
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for mp3_file in mp3_files:
-                # Clean the filename - remove the unique prefix (track_XXX_uniqueid_)
-                clean_name = mp3_file.name
-                # Remove pattern: track_###_uniqueid_ from the start
-                clean_name = re.sub(r'^track_\d{3}_[a-f0-9]{8}_', '', clean_name)
-                zipf.write(mp3_file, clean_name)
+        if not fetched:
+            if budget.exhausted('download'):
+                raise TrackDownloadError('timeout')
+            candidates = search_youtube(query, track_name, artist_name, progress_callback, budget)
+            fetched = fetch_audio(candidates, output_path, name_prefix, progress_callback,
+                                  audio_format, budget) if candidates else None
         
-        # Schedule cleanup
-        def cleanup():
+        if not fetched:
+            return track_failure(query, 'not_found')
+        return transcode_audio(fetched, name_prefix, progress_callback, audio_format, budget)
+    except TrackDownloadError as e:
+        return track_failure(query, e.reason)
+
+TRACK_FAILURE_MESSAGES = {
+    'not_found': "❌ Todas as estratégias falharam para",
+    'throttled': "🐢 YouTube limitou as requisições, falha temporária para",
+    'timeout': "⏱ Tempo esgotado para",
+    'error': "❌ Erro temporário ao baixar",
+    'cancelled': "🛑 Download cancelado",
+}
+
+def track_failure(query: str, reason: str) -> DownloadFailure:
+    logging.error(f"{TRACK_FAILURE_MESSAGES[reason]}: {query}")
+    return DownloadFailure(reason)
+
+def resolve_stream_source(candidates: List[dict],
+                          audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT,
+                          budget: Optional[TrackBudget] = None) -> Optional[Tuple[dict, dict]]:
+    """Pick the first candidate with a playable audio stream, without downloading it.
+    
+    Returns (candidate, info) where info['url'] and info['http_headers'] locate the stream,
+    or None if every candidate is unavailable. Like fetch_audio, it raises
+    TrackDownloadError when some candidate failed for a reason other than that, and
+    stops once the budget's download phase runs out.
+    """
+    budget = budget or TrackBudget.start()
+    failure = None
+    fetch_opts = {**FETCH_OPTS, 'format': audio_format.selector}
+    with ydl_pool.acquire(fetch_opts) as ydl:
+        for candidate in candidates:
+            video = candidate['video']
+            if budget.exhausted('download'):
+                failure = 'timeout'
+                break
             try:
-                shutil.rmtree(zip_dir)
-                if zip_path.exists():
-                    zip_path.unlink()
-            except:
+                log_candidate(candidate)
+                with youtube_request('media', ydl, budget.remaining('download')):
+                    info = ydl.extract_info(video_page_url(video), download=False)
+                if info and info.get('url'):
+                    return candidate, info
+                logging.warning(f"⚠ Nenhum stream de áudio disponível")
+            except TrackBudgetExceeded:
+                failure = 'timeout'
+                break
+            except Exception as e:
+                logging.error(f"❌ Erro ao resolver '{video.get('title') or video['id']}': {str(e)}")
+                failure = failure or (e.reason if isinstance(e, TrackDownloadError) else 'error')
+    if failure:
+        raise TrackDownloadError(failure)
+    return None
+
+def stream_output_args(audio_format: AudioFormat, info: dict, seekable: bool = False) -> Tuple[List[str], str]:
+    """ffmpeg output arguments for converting a source, and the resulting file extension.
+    
+    Pipes cannot be seeked, so MP4 output is fragmented unless `seekable` (a regular
+    file); codecs are copied whenever the source already has the one the format asks for.
+    When the format selector had to fall back to a stream in another codec, it is
+    re-encoded instead, and a warning says so.
+    """
+    acodec = (info.get('acodec') or '').split('.')[0]
+    name = audio_format.name
+    if name == 'native':
+        name = 'webm' if info.get('ext') == 'webm' else 'm4a'
+    
+    if name == 'mp3':
+        return ['-c:a', 'libmp3lame', '-b:a', f"{audio_format.bitrate}k", '-f', 'mp3'], '.mp3'
+    if name == 'webm':
+        return ['-c:a', 'copy', '-f', 'webm'], '.webm'
+    
+    wanted, encoder = ('opus', 'libopus') if name == 'opus' else ('mp4a', 'aac')
+    codec_args = ['-c:a', 'copy']
+    if acodec != wanted:
+        logging.warning(f"⚠ Áudio em {acodec or 'codec desconhecido'} no YouTube: recodificando para {name} "
+                        f"em vez de só trocar o contêiner")
+        codec_args = ['-c:a', encoder]
+    if name == 'opus':
+        return [*codec_args, '-f', 'ogg'], '.opus'
+    movflags = '+faststart' if seekable else 'frag_keyframe+empty_moov+default_base_moof'
+    return [*codec_args, '-f', 'mp4', '-movflags', movflags], '.m4a'
+
+def unique_archive_name(name: str, taken: set) -> str:
+    """Name for a new ZIP entry, numbered "name (2).ext" when the playlist repeats a track"""
+    stem, dot, ext = name.rpartition('.')
+    if not dot:
+        stem, ext = name, ''
+    candidate, n = name, 2
+    while candidate in taken:
+        candidate = f"{stem} ({n}){dot}{ext}"
+        n += 1
+    taken.add(candidate)
+    return candidate
+
+def build_zip_archive(audio_files: List[Path], zip_path: Path, manifest: Optional[dict] = None):
+    """Write the downloaded tracks (and an optional manifest.json) into a ZIP file on disk"""
+    names = set()
+    # Compressed audio barely shrinks, so store it as-is instead of burning CPU on deflate
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zipf:
+        if manifest is not None:
+            zipf.writestr(unique_archive_name('manifest.json', names), json.dumps(manifest, ensure_ascii=False, indent=2))
+        for audio_file in audio_files:
+            zipf.write(audio_file, unique_archive_name(archive_name(audio_file), names))
+
+class _ZipSink(io.RawIOBase):
+    """Non-seekable write target that collects the bytes zipfile produces"""
+    
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+class ZipStream:
+    """Builds a ZIP archive of stored (uncompressed) entries, handing out bytes as they are written.
+    
+    The sink is not seekable, so zipfile writes data descriptors after each entry and
+    switches to zip64 records on its own once sizes or offsets exceed the 4 GiB limits.
+    """
+    
+    CHUNK_SIZE = 256 * 1024
+    
+    def __init__(self):
+        self._sink = _ZipSink()
+        self._zip = zipfile.ZipFile(self._sink, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._names = set()
+    
+    def add_file(self, path: Path, arcname: str) -> Iterator[bytes]:
+        """Write one file as a stored entry, yielding archive bytes as they become available"""
+        zinfo = zipfile.ZipInfo.from_file(path, unique_archive_name(arcname, self._names))
+        zinfo.compress_type = zipfile.ZIP_STORED
+        with open(path, 'rb') as src, self._zip.open(zinfo, 'w') as dest:
+            while True:
+                chunk = src.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                dest.write(chunk)
+                data = self._sink.drain()
+                if data:
+                    yield data
+        data = self._sink.drain()
+        if data:
+            yield data
+    
+    def close(self) -> bytes:
+        """Write the central directory and return the final bytes of the archive"""
+        self._zip.close()
+        return self._sink.drain()
+
+@dataclass(eq=False)
+class SlotTicket:
+    """A request for a download slot: interactive, or batch work of a job (group)"""
+    group: Optional[str] = None  # None = interactive
+    future: Optional[asyncio.Future] = None
+    
+    @property
+    def interactive(self) -> bool:
+        return self.group is None
+
+# Ticket of the track the current thread works on, so the YouTube limiters can favour interactive work
+work_ticket: contextvars.ContextVar[Optional[SlotTicket]] = contextvars.ContextVar('work_ticket', default=None)
+
+def is_interactive(ticket: Optional[SlotTicket]) -> bool:
+    """Work without a ticket has nothing to yield to, so it counts as interactive"""
+    return ticket is None or ticket.interactive
+
+class PipelineStage:
+    """One stage of the track pipeline: a worker pool that hands out its workers by priority.
+    
+    At most `workers` calls run at once. The others wait here rather than in the pool's
+    FIFO queue, so the next free worker goes to the oldest interactive call (tickets are
+    read at dispatch, so promoted ones count) and only then to the oldest batch call.
+    A slow stage still pushes back on the stages feeding it. Only used from the event loop.
+    """
+    
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.free = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-stage")
+        self._waiting: List[Tuple[Optional[SlotTicket], asyncio.Future]] = []
+    
+    def _dispatch(self):
+        while self.free > 0 and self._waiting:
+            index = next((i for i, (ticket, _) in enumerate(self._waiting) if is_interactive(ticket)), 0)
+            _, waiter = self._waiting.pop(index)
+            if waiter.done():
+                continue  # cancelled
+            self.free -= 1
+            waiter.set_result(None)
+    
+    def _release(self):
+        self.free += 1
+        self._dispatch()
+    
+    def _release_soon(self, loop: asyncio.AbstractEventLoop):
+        """Release a worker from its thread, once its call has ended"""
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # the event loop is gone: the server is shutting down
+    
+    async def run(self, fn: Callable, *args, ticket: Optional[SlotTicket] = None):
+        loop = asyncio.get_event_loop()
+        if self.free > 0 and not self._waiting:
+            self.free -= 1
+        else:
+            waiter = loop.create_future()
+            self._waiting.append((ticket, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.cancelled():
+                    self._waiting = [entry for entry in self._waiting if entry[1] is not waiter]
+                else:
+                    self._release()  # granted just as we were cancelled
+                raise
+        
+        def call():
+            work_ticket.set(ticket)
+            return fn(*args)
+        
+        future = self.executor.submit(contextvars.copy_context().run, call)
+        # The worker stays taken until the call really ends, even if its awaiter is cancelled
+        future.add_done_callback(lambda _: self._release_soon(loop))
+        return await asyncio.wrap_future(future)
+
+search_stage = PipelineStage("search", SEARCH_STAGE_WORKERS)
+fetch_stage = PipelineStage("fetch", DOWNLOAD_IO_WORKERS)
+transcode_stage = PipelineStage("transcode", TRANSCODE_WORKERS)
+
+class LimiterManager(BaseManager):
+    """Serves this process's youtube_limiters to the download worker processes.
+    
+    The limiters stay in the uvicorn process, so all workers draw from the same
+    rate and concurrency limit, and a throttle backoff outlives recycled workers.
+    """
+
+def _youtube_limiter(kind: str) -> AdaptiveLimiter:
+    return youtube_limiters[kind]
+
+LimiterManager.register('youtube_limiter', callable=_youtube_limiter)
+
+def serve_youtube_limiters() -> Dict[str, AdaptiveLimiter]:
+    """Serve youtube_limiters from a thread of this process and return proxies to them for the workers"""
+    server = LimiterManager().get_server()
+    threading.Thread(target=server.serve_forever, name="limiter-server", daemon=True).start()
+    manager = LimiterManager(address=server.address)
+    manager.connect()
+    return {kind: manager.youtube_limiter(kind) for kind in youtube_limiters}
+
+class ProcessWorkerError(Exception):
+    """A process worker crashed, hung past its deadline or raised"""
+
+def _process_worker_main(conn, limiters: Dict[str, AdaptiveLimiter]):
+    """Entry point of a download worker process: run calls sent over the pipe until told to stop"""
+    # Pace YouTube requests with the parent's limiters (time.monotonic is system-wide, so
+    # the start times passed to release() compare with the parent's)
+    youtube_limiters.update(limiters)
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        fn_name, args, kwargs, with_progress, interactive = message
+        # Stand-in for the caller's ticket, for the limiters' priority
+        work_ticket.set(SlotTicket() if interactive else SlotTicket(group='batch'))
+        if with_progress:
+            # Progress events travel back over the same pipe, ahead of the result
+            kwargs['progress_callback'] = lambda event: conn.send(('event', event))
+        try:
+            result = globals()[fn_name](*args, **kwargs)
+        except Exception as e:
+            conn.send(('error', repr(e)))
+        else:
+            conn.send(('result', result))
+
+class ProcessWorker:
+    def __init__(self, ctx, limiters: Dict[str, AdaptiveLimiter]):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_process_worker_main, args=(child_conn, limiters), daemon=True,
+                                   name=DOWNLOAD_WORKER_PROCESS_NAME)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+    
+    def rss_bytes(self) -> int:
+        try:
+            with open(f"/proc/{self.process.pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return 0
+    
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+    
+    def stop(self):
+        try:
+            self.conn.send(None)
+            self.process.join(timeout=5)
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+class ProcessWorkerPool:
+    """Pool of worker processes for yt-dlp work, isolated from the uvicorn process.
+    
+    Each call runs on an idle worker (spawned on demand). Workers are recycled after
+    max_jobs calls or once their RSS goes over max_rss_bytes; a worker that dies or
+    misses the call's deadline is killed and replaced, so a hung extractor cannot hold
+    a slot forever.
+    """
+    
+    def __init__(self, size: int, max_jobs: int, max_rss_bytes: int):
+        self._ctx = multiprocessing.get_context('spawn')
+        self.max_jobs = max_jobs
+        self.max_rss_bytes = max_rss_bytes
+        self._limiters = serve_youtube_limiters()
+        self._idle: queue.Queue = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)  # free slot, worker spawned on first use
+        # Threads that block on the workers' pipes on behalf of the event loop
+        self._dispatch = ThreadPoolExecutor(max_workers=size, thread_name_prefix="process-dispatch")
+    
+    def call(self, fn_name: str, args: tuple, kwargs: dict,
+             progress_callback: Optional[Callable[[dict], None]] = None, timeout: Optional[float] = None,
+             cancelled: Optional[threading.Event] = None, interactive: bool = True):
+        worker = self._idle.get()
+        try:
+            if worker is None or not worker.process.is_alive():
+                worker = ProcessWorker(self._ctx, self._limiters)
+            worker.jobs += 1
+            worker.conn.send((fn_name, args, kwargs, progress_callback is not None, interactive))
+            
+            deadline = time.monotonic() + timeout if timeout else None
+            while True:
+                remaining = deadline - time.monotonic() if deadline else 1.0
+                if remaining <= 0:
+                    raise ProcessWorkerError(f"worker {worker.process.pid} passou do prazo de {timeout:.0f}s")
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadCancelled()
+                if not worker.conn.poll(min(remaining, 1.0)):
+                    if not worker.process.is_alive():
+                        raise ProcessWorkerError(f"worker {worker.process.pid} terminou inesperadamente")
+                    continue
+                kind, payload = worker.conn.recv()
+                if kind == 'event':
+                    if progress_callback:
+                        progress_callback(payload)
+                elif kind == 'error':
+                    raise RuntimeError(payload)
+                else:
+                    return payload
+        except (ProcessWorkerError, DownloadCancelled, EOFError, OSError) as e:
+            # The worker may be mid-download: killing it is the only way to stop it
+            if worker is not None:
+                worker.kill()
+                worker = None
+            if isinstance(e, (ProcessWorkerError, DownloadCancelled)):
+                raise
+            raise ProcessWorkerError(str(e))
+        finally:
+            if worker is not None and (worker.jobs >= self.max_jobs or worker.rss_bytes() > self.max_rss_bytes):
+                logging.info(f"♻ Reciclando worker {worker.process.pid} após {worker.jobs} downloads")
+                worker.stop()
+                worker = None
+            self._idle.put(worker)
+    
+    async def run(self, fn_name: str, args: tuple, kwargs: dict,
+                  progress_callback: Optional[Callable[[dict], None]] = None, timeout: Optional[float] = None,
+                  cancelled: Optional[threading.Event] = None, interactive: bool = True):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._dispatch,
+            functools.partial(self.call, fn_name, args, kwargs, progress_callback, timeout, cancelled, interactive)
+        )
+    
+    def shutdown(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.stop()
+        self._dispatch.shutdown(wait=False)
+
+PROCESS_WORKER_MAX_JOBS = int(os.environ.get('PROCESS_WORKER_MAX_JOBS', '50'))
+PROCESS_WORKER_MAX_RSS_MB = int(os.environ.get('PROCESS_WORKER_MAX_RSS_MB', '512'))
+PROCESS_WORKER_TIMEOUT = float(os.environ.get('PROCESS_WORKER_TIMEOUT', '600'))
+process_pool: Optional[ProcessWorkerPool] = None
+if DOWNLOAD_WORKER_MODE == 'process' and not IN_DOWNLOAD_WORKER:
+    process_pool = ProcessWorkerPool(PROCESS_WORKERS, PROCESS_WORKER_MAX_JOBS, PROCESS_WORKER_MAX_RSS_MB * 1024 * 1024)
+
+async def run_track_pipeline(query: str, output_path: Path, file_prefix: str = "", track_name: str = "", artist_name: str = "",
+                             progress_callback: Optional[Callable[[dict], None]] = None,
+                             resolved_video_id: Optional[str] = None,
+                             audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT,
+                             cancelled: Optional[threading.Event] = None,
+                             budget: Optional[TrackBudget] = None,
+                             ticket: Optional[SlotTicket] = None) -> Union[DownloadResult, DownloadFailure]:
+    """Same work as download_from_youtube, with each stage on its own pool.
+    
+    While one track is being transcoded on the CPU-sized pool, others keep searching
+    and downloading on theirs, so network and CPU work overlap during batches.
+    With DOWNLOAD_WORKER_MODE=process the whole download runs in a worker process instead.
+    Once `cancelled` is set, the worker process is killed; in thread mode the same is
+    achieved by a progress_callback that raises DownloadCancelled inside yt-dlp's hooks.
+    The budget (a new TRACK_TIME_BUDGET if none is given) includes time spent queued
+    for each stage; a worker process still busy a little after it runs out is killed.
+    The slot ticket sets the track's priority in the stages and the YouTube limiters.
+    """
+    budget = budget or TrackBudget.start()
+    if process_pool:
+        # Grace period for the worker to notice the deadline and clean up by itself
+        timeout = min(PROCESS_WORKER_TIMEOUT, budget.remaining() + YTDL_SOCKET_TIMEOUT)
+        try:
+            return await process_pool.run(
+                'download_from_youtube',
+                (query, output_path, file_prefix, track_name, artist_name),
+                {'resolved_video_id': resolved_video_id, 'audio_format': audio_format, 'budget': budget},
+                progress_callback,
+                timeout,
+                cancelled,
+                is_interactive(ticket)
+            )
+        except DownloadCancelled:
+            return track_failure(query, 'cancelled')
+        except Exception as e:
+            logging.error(f"❌ Erro no worker de download para '{query}': {e}")
+            return DownloadFailure('error')
+    
+    unique_id = str(uuid.uuid4())[:8]
+    name_prefix = f"{file_prefix}_{unique_id}_" if file_prefix else f"{unique_id}_"
+    
+    try:
+        fetched = None
+        # A previously matched video skips the search phase completely
+        if resolved_video_id:
+            fetched = await fetch_stage.run(fetch_audio, [resolved_candidate(resolved_video_id)], output_path, name_prefix,
+                                            progress_callback, audio_format, budget, ticket=ticket)
+            if not fetched:
+                logging.warning(f"⚠ Vídeo salvo indisponível, buscando novamente")
+        
+        if not fetched:
+            if budget.exhausted('download'):
+                raise TrackDownloadError('timeout')
+            candidates = await search_stage.run(search_youtube, query, track_name, artist_name, progress_callback, budget,
+                                                ticket=ticket)
+            if candidates:
+                fetched = await fetch_stage.run(fetch_audio, candidates, output_path, name_prefix, progress_callback,
+                                                audio_format, budget, ticket=ticket)
+        
+        if not fetched:
+            return track_failure(query, 'not_found')
+        if audio_format.codec is None:
+            # Nothing to convert: don't wait for a slot on the transcode pool
+            logging.info(f"✅ Download concluído com sucesso!")
+            return fetched
+        return await transcode_stage.run(transcode_audio, fetched, name_prefix, progress_callback, audio_format, budget,
+                                         ticket=ticket)
+    except TrackDownloadError as e:
+        return track_failure(query, e.reason)
+
+class DownloadScheduler:
+    """Hands out the server-wide download slots, interactive requests first.
+    
+    Batch jobs share what is left in equal parts (stride scheduling): every grant
+    advances the job's virtual time by one and the waiting job with the lowest virtual
+    time goes next, so a playlist of thousands of tracks cannot starve a small one.
+    Jobs joining later start at the current virtual time, not at zero. Shares are
+    unweighted: no request says how much it matters, and a weight chosen by the client
+    would let any caller take most of the slots.
+    Only used from the event loop.
+    """
+    
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.free = slots
+        self._interactive: deque = deque()
+        self._batch: Dict[str, deque] = {}
+        self._vtime: Dict[str, float] = {}
+        self._clock = 0.0
+    
+    @property
+    def waiting(self) -> int:
+        return len(self._interactive) + sum(len(queue) for queue in self._batch.values())
+    
+    def _enqueue(self, ticket: SlotTicket):
+        if ticket.interactive:
+            self._interactive.append(ticket)
+            return
+        if ticket.group not in self._batch:
+            self._batch[ticket.group] = deque()
+            self._vtime[ticket.group] = max(self._vtime.get(ticket.group, self._clock), self._clock)
+        self._batch[ticket.group].append(ticket)
+    
+    def _dequeue(self, ticket: SlotTicket) -> bool:
+        try:
+            if ticket.interactive:
+                self._interactive.remove(ticket)
+            else:
+                self._batch[ticket.group].remove(ticket)
+                self._drop_if_idle(ticket.group)
+        except (KeyError, ValueError):
+            return False
+        return True
+    
+    def _drop_if_idle(self, group: str):
+        if not self._batch[group]:
+            del self._batch[group]
+            del self._vtime[group]
+    
+    def _next(self) -> Optional[SlotTicket]:
+        if self._interactive:
+            return self._interactive.popleft()
+        if not self._batch:
+            return None
+        group = min(self._batch, key=self._vtime.__getitem__)
+        ticket = self._batch[group].popleft()
+        self._clock = self._vtime[group]
+        self._vtime[group] += 1
+        self._drop_if_idle(group)
+        return ticket
+    
+    def _dispatch(self):
+        while self.free > 0:
+            ticket = self._next()
+            if ticket is None:
+                return
+            if ticket.future.done():
+                continue  # cancelled, its waiter is about to dequeue it
+            self.free -= 1
+            ticket.future.set_result(None)
+    
+    async def acquire(self, ticket: SlotTicket):
+        if self.free > 0 and not self.waiting:
+            self.free -= 1
+            return
+        ticket.future = asyncio.get_event_loop().create_future()
+        self._enqueue(ticket)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if not self._dequeue(ticket) and ticket.future.done() and not ticket.future.cancelled():
+                # Granted just as we were cancelled: hand the slot on
+                self.release()
+            raise
+    
+    def release(self):
+        self.free += 1
+        self._dispatch()
+    
+    def promote(self, ticket: SlotTicket):
+        """Turn a batch request into an interactive one (a user is now waiting on it)"""
+        if ticket.interactive:
+            return
+        queued = ticket.future is not None and not ticket.future.done() and self._dequeue(ticket)
+        ticket.group = None
+        if queued:
+            self._enqueue(ticket)
+            self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, ticket: SlotTicket):
+        await self.acquire(ticket)
+        try:
+            yield
+        finally:
+            self.release()
+
+download_scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS)
+
+class AdmissionTicket:
+    """Track work admitted by the AdmissionController, given back as the tracks finish"""
+    
+    def __init__(self, controller: "AdmissionController", tracks: int, interactive: bool):
+        self.controller = controller
+        self.remaining = tracks
+        self.interactive = interactive
+    
+    def done(self, tracks: int = 1):
+        tracks = min(tracks, self.remaining)
+        self.remaining -= tracks
+        self.controller._finished(tracks, self.interactive)
+    
+    def release(self):
+        self.done(self.remaining)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+    """Counts accepted but unfinished track work and answers 429 once too much is queued.
+    
+    Batch and interactive work have separate limits, so a full batch queue never blocks
+    single-track downloads (the scheduler runs those first anyway). Retry-After is the
+    time the slots need to drain the excess, from a moving average of track durations.
+    """
+    
+    # Weight of the newest sample in the moving average of track durations
+    EWMA_ALPHA = 0.1
+    
+    def __init__(self, max_batch_tracks: int, max_interactive: int, slots: int, initial_track_seconds: float):
+        self.max_batch_tracks = max_batch_tracks
+        self.max_interactive = max_interactive
+        self.slots = slots
+        self.track_seconds = initial_track_seconds
+        self.batch = 0
+        self.interactive = 0
+    
+    def observe(self, seconds: float):
+        """Record how long one track took to download"""
+        self.track_seconds += self.EWMA_ALPHA * (seconds - self.track_seconds)
+    
+    def drain_seconds(self, tracks: int) -> int:
+        return max(1, math.ceil(tracks * self.track_seconds / self.slots))
+    
+    def admit(self, tracks: int, interactive: bool = False) -> AdmissionTicket:
+        if interactive:
+            excess = self.interactive + tracks - self.max_interactive
+        else:
+            # An idle server takes any playlist, however long
+            excess = min(self.batch, self.batch + tracks - self.max_batch_tracks)
+        if excess > 0:
+            retry_after = self.drain_seconds(excess)
+            logging.warning(f"⛔ Servidor ocupado ({self.batch} em lote, {self.interactive} individuais), "
+                            f"recusando {tracks} músicas; tentar em {retry_after}s")
+            raise HTTPException(
+                status_code=429,
+                detail="Servidor ocupado no momento. Tente novamente em alguns instantes.",
+                headers={"Retry-After": str(retry_after)}
+            )
+        if interactive:
+            self.interactive += tracks
+        else:
+            self.batch += tracks
+        return AdmissionTicket(self, tracks, interactive)
+    
+    def _finished(self, tracks: int, interactive: bool):
+        if interactive:
+            self.interactive -= tracks
+        else:
+            self.batch -= tracks
+    
+    @property
+    def accepting(self) -> bool:
+        return self.batch < self.max_batch_tracks and self.interactive < self.max_interactive
+    
+    def snapshot(self) -> dict:
+        return {
+            'accepting': self.accepting,
+            'queued_batch_tracks': self.batch,
+            'queued_interactive_tracks': self.interactive,
+            'max_batch_tracks': self.max_batch_tracks,
+            'max_interactive_tracks': self.max_interactive,
+            'download_slots': self.slots,
+            'free_download_slots': download_scheduler.free,
+            'waiting_for_slot': download_scheduler.waiting,
+            'avg_track_seconds': round(self.track_seconds, 1),
+            'estimated_drain_seconds': self.drain_seconds(self.batch + self.interactive),
+        }
+
+# Track work accepted but not finished yet, batch and interactive
+MAX_QUEUED_BATCH_TRACKS = int(os.environ.get('MAX_QUEUED_BATCH_TRACKS', '2000'))
+MAX_QUEUED_INTERACTIVE = int(os.environ.get('MAX_QUEUED_INTERACTIVE', str(MAX_CONCURRENT_DOWNLOADS * 4)))
+admission = AdmissionController(MAX_QUEUED_BATCH_TRACKS, MAX_QUEUED_INTERACTIVE, MAX_CONCURRENT_DOWNLOADS,
+                                float(os.environ.get('INITIAL_TRACK_SECONDS', '30')))
+
+@dataclass
+class TrackFlight:
+    """A track download in progress, shared by every caller asking for the same track"""
+    work_dir: Path
+    ticket: SlotTicket
+    task: Optional[asyncio.Task] = None
+    callbacks: List[Callable[[dict], None]] = field(default_factory=list)
+    waiters: int = 0
+    # Set when every caller is gone; seen by the worker threads, which can't be cancelled
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    
+    def progress(self, event: dict):
+        """Progress hook of the download, called from the worker thread"""
+        if self.cancelled.is_set():
+            # Raised inside yt-dlp's hooks, this aborts the download in progress
+            raise DownloadCancelled()
+        for callback in list(self.callbacks):
+            callback(event)
+
+# In-flight downloads by (track id, format variant)
+track_flights: Dict[Tuple[str, str], TrackFlight] = {}
+
+async def resolve_track(track_id: str, track_name: str, track_artist: str, work_dir: Path, ticket: SlotTicket,
+                        progress_callback: Optional[Callable[[dict], None]] = None,
+                        audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT,
+                        cancelled: Optional[threading.Event] = None) -> Optional[Tuple[Path, str]]:
+    """Get the audio for a track that is not in the cache yet, returning (file, file name)"""
+    variant = audio_format.variant
+    
+    # Already matched before: reuse the cached audio of that video, or skip the search
+    resolution = await get_resolution(track_id)
+    resolved_video_id = resolution['video_id'] if resolution else None
+    loop = asyncio.get_event_loop()
+    if resolved_video_id:
+        cached_path = await loop.run_in_executor(cache_executor, audio_cache.lookup_video, resolved_video_id, variant)
+        if cached_path:
+            filename = yt_dlp.utils.sanitize_filename(f"{track_name} - {track_artist}{cached_path.suffix}")
+            await loop.run_in_executor(cache_executor, audio_cache.link_track, track_id, variant, resolved_video_id,
+                                       filename)
+            logging.info(f"⚡ Cache hit (vídeo {resolved_video_id}): {track_name}")
+            return cached_path, filename
+    
+    query = f"{track_name} {track_artist}"
+    work_dir.mkdir(exist_ok=True)
+    async with download_scheduler.slot(ticket):
+        started = time.monotonic()
+        result = await run_track_pipeline(
+            query,
+            work_dir,
+            "",
+            track_name,  # track_name for matching
+            track_artist,  # artist_name for matching
+            progress_callback,
+            resolved_video_id,
+            audio_format,
+            cancelled,
+            ticket=ticket
+        )
+        admission.observe(time.monotonic() - started)
+    if isinstance(result, DownloadFailure):
+        # Throttling, timeouts and errors say nothing about the track: only "not found" is remembered
+        if result.permanent:
+            unresolvable_tracks.add(track_id, query)
+        return None
+    
+    unresolvable_tracks.discard(track_id, query)
+    if result.video_id != resolved_video_id:
+        await save_resolution(track_id, result)
+    await loop.run_in_executor(cache_executor, audio_cache.publish, track_id, variant, result)
+    return result.path, result.filename
+
+async def fetch_track(track_id: str, track_name: str, track_artist: str, output_dir: Path, file_prefix: str = "",
+                      progress_callback: Optional[Callable[[dict], None]] = None,
+                      audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT, force_retry: bool = False,
+                      batch_group: Optional[str] = None) -> Optional[Path]:
+    """Put the audio for a track into output_dir, from the audio cache when possible.
+    
+    Concurrent calls for the same track and format share a single download: the first
+    one starts it, the others wait for it and get their own link to the same file.
+    Tracks that failed recently return None right away unless force_retry is set.
+    Calls with a batch_group (the batch job they belong to) yield to interactive ones.
+    """
+    unique_id = str(uuid.uuid4())[:8]
+    name_prefix = f"{file_prefix}_{unique_id}_" if file_prefix else f"{unique_id}_"
+    
+    loop = asyncio.get_event_loop()
+    cached = await loop.run_in_executor(cache_executor, audio_cache.lookup, track_id, audio_format.variant)
+    if cached:
+        cached_path, filename = cached
+        dest = output_dir / f"{name_prefix}{filename}"
+        await loop.run_in_executor(cache_executor, link_or_copy, cached_path, dest)
+        logging.info(f"⚡ Cache hit: {track_name}")
+        return dest
+    
+    if not force_retry and unresolvable_tracks.contains(track_id, f"{track_name} {track_artist}"):
+        logging.info(f"⏭ Pulando '{track_name}': falhou recentemente")
+        return None
+    
+    key = (track_id, audio_format.variant)
+    flight = track_flights.get(key)
+    if flight is None:
+        flight = TrackFlight(work_dir=DOWNLOAD_DIR / f"flight_{uuid.uuid4().hex}", ticket=SlotTicket(batch_group))
+        flight.task = asyncio.ensure_future(
+            resolve_track(track_id, track_name, track_artist, flight.work_dir, flight.ticket, flight.progress,
+                          audio_format, flight.cancelled)
+        )
+        track_flights[key] = flight
+    else:
+        logging.info(f"🔗 Aguardando download já em andamento: {track_name}")
+        if batch_group is None:
+            download_scheduler.promote(flight.ticket)
+    
+    flight.waiters += 1
+    if progress_callback:
+        flight.callbacks.append(progress_callback)
+    try:
+        # Shielded: one caller giving up must not cancel the download for the others
+        resolved = await asyncio.shield(flight.task)
+        if not resolved:
+            return None
+        path, filename = resolved
+        dest = output_dir / f"{name_prefix}{filename}"
+        await loop.run_in_executor(cache_executor, link_or_copy, path, dest)
+        return dest
+    finally:
+        flight.waiters -= 1
+        if progress_callback:
+            flight.callbacks.remove(progress_callback)
+        if flight.waiters == 0:
+            # Last caller out: nobody else can link the shared file any more
+            if track_flights.get(key) is flight:
+                del track_flights[key]
+            if not flight.task.done():
+                logging.info(f"🛑 Download cancelado, ninguém mais aguarda: {track_name}")
+                flight.cancelled.set()
+                flight.task.cancel()
+            shutil.rmtree(flight.work_dir, ignore_errors=True)
+
+async def iter_track_downloads(tracks: List[Track], output_dir: Path, concurrency: int,
+                               on_progress: Optional[Callable[[int, dict], None]] = None,
+                               audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT, force_retry: bool = False,
+                               admitted: Optional[AdmissionTicket] = None
+                               ) -> AsyncIterator[Tuple[int, Track, Optional[Path]]]:
+    """Download tracks with bounded concurrency, yielding (index, track, path or None) as each one finishes.
+    
+    on_progress(index, event) is called on the event loop for every progress event of a track.
+    The admission ticket of the batch, if any, is given back track by track.
+    """
+    loop = asyncio.get_event_loop()
+    job_slots = asyncio.Semaphore(concurrency)
+    total = len(tracks)
+    # Each batch is its own job for the scheduler's fair sharing
+    batch_group = uuid.uuid4().hex
+    
+    async def download_one(idx: int, track: Track) -> Tuple[int, Track, Optional[Path]]:
+        async with job_slots:
+            try:
+                # Pass unique prefix to avoid file overwrites
+                file_prefix = f"track_{idx:04d}"
+                progress_callback = None
+                if on_progress:
+                    # Hooks fire on the worker thread; hand events back to the loop
+                    progress_callback = lambda event: loop.call_soon_threadsafe(on_progress, idx, event)
+                path = await fetch_track(track.id, track.name, track.artist, output_dir, file_prefix,
+                                         progress_callback, audio_format, force_retry, batch_group)
+            except Exception as e:
+                logging.error(f"Failed to download {track.name}: {e}")
+                return idx, track, None
+        
+        if path:
+            logging.info(f"✓ Baixado com sucesso [{idx+1}/{total}]: {track.name}")
+        else:
+            logging.warning(f"✗ Falha ao baixar [{idx+1}/{total}]: {track.name}")
+        return idx, track, path
+    
+    tasks = [asyncio.ensure_future(download_one(idx, track)) for idx, track in enumerate(tracks)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if admitted:
+                admitted.done()
+            yield result
+    finally:
+        # Consumer went away (e.g. client disconnected): stop the remaining work
+        for task in tasks:
+            task.cancel()
+        if admitted:
+            admitted.release()
+
+async def download_tracks_concurrently(tracks: List[Track], output_dir: Path, concurrency: int,
+                                      audio_format: AudioFormat = DEFAULT_AUDIO_FORMAT,
+                                      force_retry: bool = False,
+                                      admitted: Optional[AdmissionTicket] = None) -> List[Optional[Path]]:
+    """Download tracks with bounded concurrency, returning the files (None if failed) in playlist order"""
+    results: List[Optional[Path]] = [None] * len(tracks)
+    async for idx, _, path in iter_track_downloads(tracks, output_dir, concurrency, audio_format=audio_format,
+                                                   force_retry=force_retry, admitted=admitted):
+        results[idx] = path
+    return results
+
+class DownloadJob:
+    """A batch download running in the background, with a replayable event log"""
+    
+    # Minimum interval between 'downloading' events of the same track
+    PROGRESS_INTERVAL = 0.5
+    
+    def __init__(self, request: DownloadAllRequest):
+        self.id = str(uuid.uuid4())
+        self.request = request
+        self.status = 'queued'
+        self.work_dir = DOWNLOAD_DIR / self.id
+        self.zip_path = DOWNLOAD_DIR / f"{self.id}.zip"
+        self.completed_tracks = 0
+        self.successful_downloads = 0
+        self.failed_tracks: List[str] = []
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+        self.events: List[dict] = []
+        self.task: Optional[asyncio.Task] = None
+        self.admitted: Optional[AdmissionTicket] = None
+        self._changed = asyncio.Event()
+        self._last_progress: Dict[int, float] = {}
+    
+    @property
+    def finished(self) -> bool:
+        return self.status in ('completed', 'failed')
+    
+    def publish(self, event: dict):
+        event['seq'] = len(self.events)
+        self.events.append(event)
+        # Wake everyone waiting on the current event, then arm a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    def publish_track_event(self, idx: int, event: dict):
+        if event.get('status') == 'downloading':
+            now = time.monotonic()
+            done = event.get('total_bytes') and event.get('downloaded_bytes') == event.get('total_bytes')
+            if not done and now - self._last_progress.get(idx, 0) < self.PROGRESS_INTERVAL:
+                return
+            self._last_progress[idx] = now
+        track = self.request.tracks[idx]
+        self.publish({'type': 'track', 'index': idx, 'track_id': track.id, 'name': track.name, **event})
+    
+    def set_status(self, status: str):
+        self.status = status
+        if self.finished:
+            self.finished_at = datetime.now(timezone.utc)
+        self.publish({
+            'type': 'job',
+            'status': status,
+            'successful_downloads': self.successful_downloads,
+            'failed_tracks': list(self.failed_tracks),
+        })
+    
+    async def iter_events(self, start: int = 0) -> AsyncIterator[dict]:
+        """Yield events from `start` on, following the log until the job finishes"""
+        idx = start
+        while True:
+            changed = self._changed
+            while idx < len(self.events):
+                yield self.events[idx]
+                idx += 1
+            if self.finished:
+                return
+            await changed.wait()
+    
+    def to_response(self) -> JobStatusResponse:
+        return JobStatusResponse(
+            job_id=self.id,
+            playlist_id=self.request.playlist_id,
+            status=self.status,
+            total_tracks=len(self.request.tracks),
+            completed_tracks=self.completed_tracks,
+            successful_downloads=self.successful_downloads,
+            failed_tracks=self.failed_tracks,
+            created_at=self.created_at,
+            finished_at=self.finished_at,
+            artifact_ready=self.status == 'completed' and self.zip_path.exists(),
+        )
+    
+    def cleanup(self):
+        try:
+            shutil.rmtree(self.work_dir)
+        except:
+            pass
+        try:
+            if self.zip_path.exists():
+                self.zip_path.unlink()
+        except:
+            pass
+
+# Background download jobs, kept for JOB_TTL_SECONDS after they finish
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', '3600'))
+jobs: Dict[str, DownloadJob] = {}
+
+def expire_job(job_id: str):
+    job = jobs.pop(job_id, None)
+    if job:
+        job.cleanup()
+
+async def run_download_job(job: DownloadJob):
+    """Run a batch download job and build its ZIP artifact"""
+    loop = asyncio.get_event_loop()
+    try:
+        job.work_dir.mkdir(exist_ok=True)
+        job.set_status('running')
+        
+        concurrency = min(job.request.max_concurrency or BATCH_CONCURRENCY_PER_JOB, BATCH_CONCURRENCY_PER_JOB)
+        downloaded: Dict[int, Path] = {}
+        async for idx, track, path in iter_track_downloads(job.request.tracks, job.work_dir, concurrency,
+                                                           on_progress=job.publish_track_event,
+                                                           audio_format=job.request.audio_format(),
+                                                           force_retry=job.request.force_retry,
+                                                           admitted=job.admitted):
+            job.completed_tracks += 1
+            if path:
+                job.successful_downloads += 1
+                downloaded[idx] = path
+            else:
+                job.failed_tracks.append(track.name)
+            job.publish_track_event(idx, {'status': 'done' if path else 'failed'})
+        
+        # Playlist order
+        audio_files = [downloaded[idx] for idx in sorted(downloaded)]
+        if not audio_files:
+            job.set_status('failed')
+            return
+        
+        await loop.run_in_executor(executor, build_zip_archive, audio_files, job.zip_path)
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        
+        total = len(job.request.tracks)
+        logging.info(f"Job {job.id} summary: {job.successful_downloads}/{total} successful. Failed: {job.failed_tracks}")
+        job.set_status('completed')
+    except Exception as e:
+        logging.error(f"Error running download job {job.id}: {e}")
+        job.set_status('failed')
+    finally:
+        if job.admitted:
+            job.admitted.release()
+        loop.call_later(JOB_TTL_SECONDS, expire_job, job.id)
+
+def get_job(job_id: str) -> DownloadJob:
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Download não encontrado ou expirado.")
+    return job
+
+class SpotifyAPIError(Exception):
+    """Error response from the Spotify Web API"""
+    
+    def __init__(self, status: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+class SpotifyGovernor:
+    """Paces Spotify Web API calls with a token bucket shared by every request of this process.
+    
+    Callers queue in arrival order for a token (refilled at `rate` per second, up to
+    `burst`). A 429 empties the bucket and pauses it for the response's Retry-After, and
+    the rejected call queues again instead of failing; only a caller that would wait
+    more than `max_wait` seconds in total gets the 429.
+    """
+    
+    def __init__(self, rate: float, burst: int, max_wait: float):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._queue = asyncio.Lock()  # FIFO, so callers are served in arrival order
+    
+    def _delay(self, now: float) -> float:
+        """Seconds until a token is available, refilling the bucket up to now"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.rate <= 0:
+            return 0.0
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        return max((1 - self._tokens) / self.rate, 0.0)
+    
+    async def acquire(self, deadline: float):
+        """Wait for a token, raising a 429 SpotifyAPIError if none comes before `deadline` (monotonic)"""
+        async with self._queue:
+            while True:
+                now = time.monotonic()
+                delay = self._delay(now)
+                if delay <= 0:
+                    self._tokens -= 1
+                    return
+                if now + delay > deadline:
+                    raise SpotifyAPIError(429, "rate limit", retry_after=delay)
+                # A 429 seen meanwhile may push the pause further, so check again after sleeping
+                await asyncio.sleep(delay)
+    
+    def throttled(self, retry_after: float):
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + retry_after)
+        self._tokens = 0.0
+        self._refilled = self._paused_until
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Seconds from a Retry-After header (Spotify sends seconds, not dates)"""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+class SpotifyAPI:
+    """Async Spotify Web API client (client credentials flow) over a pooled HTTP client.
+    
+    The access token is cached in memory and in MongoDB, so all uvicorn workers share
+    one token instead of each requesting its own; a 401 forces a fresh one.
+    API calls go through the governor, which queues them under Spotify's rate limits.
+    """
+    
+    API_URL = "https://api.spotify.com/v1"
+    TOKEN_URL = "https://accounts.spotify.com/api/token"
+    # Refresh tokens this many seconds before Spotify expires them
+    TOKEN_MARGIN = 60
+    
+    def __init__(self, client_id: Optional[str], client_secret: Optional[str], tokens, max_connections: int,
+                 timeout: float, governor: SpotifyGovernor):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tokens = tokens
+        self.governor = governor
+        self.http = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        self._token: Optional[dict] = None
+        self._token_lock = asyncio.Lock()
+    
+    def _usable(self, token: Optional[dict]) -> bool:
+        return bool(token) and token['expires_at'] - self.TOKEN_MARGIN > time.time()
+    
+    async def _load_shared_token(self) -> Optional[dict]:
+        try:
+            return await asyncio.wait_for(
+                self.tokens.find_one({'_id': 'client_credentials'}, {'_id': 0}),
+                RESOLUTION_DB_TIMEOUT
+            )
+        except Exception as e:
+            logging.warning(f"⚠ Falha ao ler token do Spotify no MongoDB: {e!r}")
+            return None
+    
+    async def _save_shared_token(self, token: dict):
+        try:
+            await asyncio.wait_for(
+                self.tokens.replace_one({'_id': 'client_credentials'}, token, upsert=True),
+                RESOLUTION_DB_TIMEOUT
+            )
+        except Exception as e:
+            logging.warning(f"⚠ Falha ao salvar token do Spotify no MongoDB: {e!r}")
+    
+    async def _request_token(self) -> dict:
+        response = await self.http.post(
+            self.TOKEN_URL,
+            data={'grant_type': 'client_credentials'},
+            auth=(self.client_id or '', self.client_secret or '')
+        )
+        if response.status_code != 200:
+            raise SpotifyAPIError(response.status_code, response.text)
+        data = response.json()
+        return {'access_token': data['access_token'], 'expires_at': time.time() + data['expires_in']}
+    
+    async def access_token(self, refresh: bool = False) -> str:
+        """Current access token; refresh=True replaces one that Spotify rejected"""
+        stale = self._token if refresh else None
+        if not refresh and self._usable(self._token):
+            return self._token['access_token']
+        async with self._token_lock:
+            # Another request may have refreshed it while we waited for the lock
+            if self._usable(self._token) and self._token is not stale:
+                return self._token['access_token']
+            token = await self._load_shared_token()
+            if not self._usable(token) or (stale and token['access_token'] == stale['access_token']):
+                token = await self._request_token()
+                await self._save_shared_token(token)
+            self._token = token
+            return token['access_token']
+    
+    async def get(self, path: str, params: Optional[dict] = None) -> dict:
+        refresh = False
+        deadline = time.monotonic() + self.governor.max_wait
+        while True:
+            await self.governor.acquire(deadline)
+            token = await self.access_token(refresh)
+            response = await self.http.get(
+                f"{self.API_URL}{path}",
+                params=params,
+                headers={'Authorization': f"Bearer {token}"}
+            )
+            if response.status_code == 401 and not refresh:
+                refresh = True
+                continue
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                logging.warning(f"🐢 Spotify limitou as requisições, aguardando {retry_after:.0f}s")
+                self.governor.throttled(retry_after)
+                continue
+            if response.status_code != 200:
+                try:
+                    message = response.json()['error']['message']
+                except Exception:
+                    message = response.text
+                raise SpotifyAPIError(response.status_code, message)
+            return response.json()
+    
+    async def aclose(self):
+        await self.http.aclose()
+
+# Spotify playlist pages are fetched in parallel once the first page tells the total
+SPOTIFY_PAGE_SIZE = 100
+SPOTIFY_MAX_CONNECTIONS = int(os.environ.get('SPOTIFY_MAX_CONNECTIONS', '8'))
+SPOTIFY_TIMEOUT = float(os.environ.get('SPOTIFY_TIMEOUT', '15'))
+# Requests per second for the whole server, split evenly between the uvicorn workers (0 = unpaced)
+SPOTIFY_RATE = float(os.environ.get('SPOTIFY_RATE', '10'))
+SPOTIFY_BURST = int(os.environ.get('SPOTIFY_BURST', '20'))
+UVICORN_WORKERS = max(int(os.environ.get('WEB_CONCURRENCY', '1')), 1)
+# Longest a caller queues behind the rate limit before the request fails with 503
+SPOTIFY_MAX_WAIT = float(os.environ.get('SPOTIFY_MAX_WAIT', '60'))
+spotify_api = SpotifyAPI(
+    os.environ.get('SPOTIFY_CLIENT_ID'),
+    os.environ.get('SPOTIFY_CLIENT_SECRET'),
+    db.spotify_tokens,
+    SPOTIFY_MAX_CONNECTIONS,
+    SPOTIFY_TIMEOUT,
+    SpotifyGovernor(SPOTIFY_RATE / UVICORN_WORKERS, max(SPOTIFY_BURST // UVICORN_WORKERS, 1), SPOTIFY_MAX_WAIT)
+)
+
+# Only the attributes Track and PlaylistResponse use
+SPOTIFY_ITEM_FIELDS = "track(id,name,duration_ms,artists(name),album(name,images(url)))"
+SPOTIFY_PLAYLIST_FIELDS = f"id,name,description,images(url),snapshot_id,tracks(total,items({SPOTIFY_ITEM_FIELDS}))"
+
+def track_from_item(item: dict) -> Optional[Track]:
+    """Track of a playlist item, or None for removed tracks and local files"""
+    track = item.get('track')
+    if not track or not track.get('id'):
+        return None
+    return Track(
+        id=track['id'],
+        name=track['name'],
+        artist=', '.join([artist['name'] for artist in track['artists']]),
+        album=track['album']['name'],
+        image_url=track['album']['images'][0]['url'] if track['album'].get('images') else None,
+        duration_ms=track['duration_ms']
+    )
+
+async def fetch_playlist(playlist_id: str) -> Tuple[dict, List[dict]]:
+    """Fetch a playlist and all of its items, returning (playlist, items in playlist order)"""
+    playlist = await spotify_api.get(
+        f"/playlists/{playlist_id}",
+        {'fields': SPOTIFY_PLAYLIST_FIELDS, 'market': 'BR'}
+    )
+    first_page = playlist['tracks']
+    items = list(first_page['items'])
+    
+    # The connection pool bounds how many of these run at once
+    offsets = range(len(items), first_page['total'], SPOTIFY_PAGE_SIZE) if items else []
+    pages = await asyncio.gather(*(
+        spotify_api.get(
+            f"/playlists/{playlist_id}/tracks",
+            {'fields': f"items({SPOTIFY_ITEM_FIELDS})", 'limit': SPOTIFY_PAGE_SIZE, 'offset': offset,
+             'market': 'BR', 'additional_types': 'track'}
+        )
+        for offset in offsets
+    ))
+    for page in pages:
+        items.extend(page['items'])
+    return playlist, items
+
+@dataclass
+class CachedPlaylist:
+    response: PlaylistResponse
+    body: bytes  # response serialized once, served as-is
+    etag: Optional[str]
+    checked_at: float  # last time snapshot_id was confirmed with Spotify (monotonic)
+
+# Playlists by id; after PLAYLIST_REVALIDATE_SECONDS an entry is revalidated by its snapshot_id
+PLAYLIST_REVALIDATE_SECONDS = float(os.environ.get('PLAYLIST_REVALIDATE_SECONDS', '60'))
+PLAYLIST_CACHE_MAX_ENTRIES = int(os.environ.get('PLAYLIST_CACHE_MAX_ENTRIES', '256'))
+playlist_cache: "OrderedDict[str, CachedPlaylist]" = OrderedDict()
+
+async def load_playlist(playlist_id: str) -> CachedPlaylist:
+    """Get a playlist from the cache, or from Spotify when it changed since it was cached.
+    
+    Revalidating only asks Spotify for the snapshot_id, so an unchanged playlist costs
+    one small request instead of fetching every page again.
+    """
+    now = time.monotonic()
+    cached = playlist_cache.get(playlist_id)
+    if cached and now - cached.checked_at >= PLAYLIST_REVALIDATE_SECONDS:
+        try:
+            current = await spotify_api.get(f"/playlists/{playlist_id}", {'fields': 'snapshot_id', 'market': 'BR'})
+        except SpotifyAPIError as e:
+            if e.status != 429:
+                raise
+            # Rate limited: a slightly stale playlist beats an error
+            logging.warning(f"⚠ Spotify limitando requisições, usando playlist em cache: {playlist_id}")
+            current = {'snapshot_id': cached.response.snapshot_id}
+        if current.get('snapshot_id') == cached.response.snapshot_id:
+            cached.checked_at = now
+        else:
+            cached = None
+    if cached:
+        playlist_cache.move_to_end(playlist_id)
+        return cached
+    
+    # Get playlist from Spotify with market parameter, every page of it
+    playlist, items = await fetch_playlist(playlist_id)
+    
+    # Extract tracks
+    tracks = [track for track in map(track_from_item, items) if track]
+    
+    if not tracks:
+        raise HTTPException(status_code=400, detail="Esta playlist está vazia ou não possui músicas disponíveis.")
+    
+    response = PlaylistResponse(
+        id=playlist['id'],
+        name=playlist['name'],
+        description=playlist.get('description'),
+        image_url=playlist['images'][0]['url'] if playlist.get('images') else None,
+        total_tracks=len(tracks),
+        tracks=tracks,
+        snapshot_id=playlist.get('snapshot_id')
+    )
+    snapshot_id = response.snapshot_id
+    entry = CachedPlaylist(
+        response=response,
+        body=response.model_dump_json().encode(),
+        etag=f'"{snapshot_id}"' if snapshot_id else None,
+        checked_at=now
+    )
+    if snapshot_id:
+        playlist_cache[playlist_id] = entry
+        playlist_cache.move_to_end(playlist_id)
+        while len(playlist_cache) > PLAYLIST_CACHE_MAX_ENTRIES:
+            playlist_cache.popitem(last=False)
+    return entry
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header value covers etag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+async def get_playlist_entry(playlist_id: str) -> CachedPlaylist:
+    """load_playlist with Spotify errors turned into the API's HTTP errors"""
+    try:
+        return await load_playlist(playlist_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logging.error(f"Error fetching playlist: {error_msg}")
+        
+        # Check for specific error types
+        if isinstance(e, SpotifyAPIError) and e.status == 429:
+            raise HTTPException(
+                status_code=503,
+                detail="O Spotify está limitando as requisições no momento. Tente novamente em instantes.",
+                headers={"Retry-After": str(math.ceil(e.retry_after or 1))}
+            )
+        elif '404' in error_msg:
+            raise HTTPException(
+                status_code=404, 
+                detail="Playlist não encontrada. Verifique se a URL está correta e se a playlist é pública. Nota: algumas playlists geradas pelo Spotify podem ter restrições regionais."
+            )
+        elif '401' in error_msg or '403' in error_msg:
+            raise HTTPException(status_code=403, detail="Acesso negado. A playlist pode ser privada.")
+        else:
+            raise HTTPException(status_code=500, detail="Erro ao buscar playlist. Tente novamente.")
+
+async def playlist_response(playlist_id: str, if_none_match: Optional[str]) -> Response:
+    """Playlist JSON with an ETag, or 304 when the client already has this version"""
+    entry = await get_playlist_entry(playlist_id)
+    
+    # Clients and proxies may keep a copy but have to revalidate it with the ETag
+    headers = {"Cache-Control": "no-cache"}
+    if entry.etag:
+        headers["ETag"] = entry.etag
+        if etag_matches(if_none_match, entry.etag):
+            return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
+# Per (playlist, sync_id): the snapshot_id and tracks delivered by the last sync
+playlist_syncs = db.playlist_syncs
+
+async def load_sync_state(playlist_id: str, sync_id: str) -> Optional[dict]:
+    try:
+        return await asyncio.wait_for(
+            playlist_syncs.find_one({'playlist_id': playlist_id, 'sync_id': sync_id}, {'_id': 0}),
+            RESOLUTION_DB_TIMEOUT
+        )
+    except Exception as e:
+        # Without the previous state a sync would silently turn into a full download
+        logging.error(f"❌ Falha ao ler sincronização de {playlist_id}: {e!r}")
+        raise HTTPException(status_code=503, detail="Sincronização indisponível no momento. Tente novamente.")
+
+async def save_sync_state(playlist_id: str, sync_id: str, snapshot_id: Optional[str], tracks: List[dict]):
+    """Record what a sync delivered; runs once its ZIP is sent, so a failure only means resending it next time"""
+    try:
+        await asyncio.wait_for(
+            playlist_syncs.update_one(
+                {'playlist_id': playlist_id, 'sync_id': sync_id},
+                {'$set': {
+                    'snapshot_id': snapshot_id,
+                    'tracks': tracks,
+                    'synced_at': datetime.now(timezone.utc),
+                }},
+                upsert=True
+            ),
+            RESOLUTION_DB_TIMEOUT
+        )
+    except Exception as e:
+        logging.error(f"❌ Falha ao salvar sincronização de {playlist_id}: {e!r}")
+
+class DeliveredFileResponse(FileResponse):
+    """FileResponse that runs `on_delivery` only if the client was still connected for the end of the body.
+    
+    uvicorn silently drops writes to a closed connection, so the response's own
+    background task also runs for clients that left halfway through.
+    """
+    
+    def __init__(self, *args, on_delivery: Optional[BackgroundTask] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_delivery = on_delivery
+    
+    async def __call__(self, scope, receive, send):
+        delivered = False
+        
+        async def send_tracking_delivery(message):
+            nonlocal delivered
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                delivered = not await Request(scope, receive).is_disconnected()
+            await send(message)
+        
+        await super().__call__(scope, receive, send_tracking_delivery)
+        if delivered and self.on_delivery is not None:
+            await self.on_delivery()
+
+class ClientDisconnected(Exception):
+    """The client went away before its response was ready"""
+
+# nginx's status for requests the client abandoned; logged only, nobody receives it
+CLIENT_CLOSED_REQUEST = 499
+# How often handlers check whether their client is still connected
+DISCONNECT_POLL_INTERVAL = float(os.environ.get('DISCONNECT_POLL_INTERVAL', '1'))
+
+async def cancel_on_disconnect(http_request: Request, awaitable):
+    """Await `awaitable`, cancelling it and raising ClientDisconnected if the client disconnects first"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            # Let the cancelled work release its slots and files before we go on
+            try:
+                await task
+            except BaseException:
+                pass
+
+@api_router.get("/")
+async def root():
+    return {"message": "Spotify Playlist Downloader API"}
+
+@api_router.get("/load")
+async def get_load():
+    """Queue depth for load balancers: 503 while the instance is turning work away"""
+    load = {**admission.snapshot(), 'youtube': {kind: limiter.snapshot() for kind, limiter in youtube_limiters.items()}}
+    return JSONResponse(content=load, status_code=200 if load['accepting'] else 503)
+
+@api_router.post("/playlist", response_model=PlaylistResponse)
+async def get_playlist(request: PlaylistRequest, if_none_match: Optional[str] = Header(default=None)):
+    """Get playlist information from Spotify"""
+    try:
+        # Extract playlist ID
+        playlist_id = extract_playlist_id(request.url)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await playlist_response(playlist_id, if_none_match)
+
+@api_router.get("/playlist/{playlist_id}", response_model=PlaylistResponse)
+async def get_playlist_by_id(playlist_id: str, if_none_match: Optional[str] = Header(default=None)):
+    """Same as POST /playlist, but a GET by id so browsers and proxies can cache it"""
+    if not re.fullmatch(r'[a-zA-Z0-9]+', playlist_id):
+        raise HTTPException(status_code=400, detail="Invalid Spotify playlist URL")
+    return await playlist_response(playlist_id, if_none_match)
+
+@api_router.post("/download-track")
+async def download_track(request: DownloadRequest, background_tasks: BackgroundTasks, http_request: Request):
+    """Download a single track"""
+    try:
+        audio_format = request.audio_format()
+        filename = f"{request.track_name} - {request.track_artist}"
+        
+        # Serve straight from the audio cache when we already have this track
+        loop = asyncio.get_event_loop()
+        cached = await loop.run_in_executor(cache_executor, audio_cache.lookup, request.track_id, audio_format.variant)
+        if cached:
+            cached_path = cached[0]
+            logging.info(f"⚡ Cache hit: {request.track_name}")
+            return FileResponse(
+                path=cached_path,
+                filename=f"{filename}{cached_path.suffix}",
+                media_type=AUDIO_MEDIA_TYPES.get(cached_path.suffix, "application/octet-stream")
+            )
+        
+        # Create unique directory for this download
+        download_id = str(uuid.uuid4())
+        track_dir = DOWNLOAD_DIR / download_id
+        
+        # Download in background with track name and artist for intelligent matching
+        with admission.admit(1, interactive=True):
+            track_dir.mkdir(exist_ok=True)
+            try:
+                file_path = await cancel_on_disconnect(http_request, fetch_track(
+                    request.track_id, request.track_name, request.track_artist, track_dir,
+                    audio_format=audio_format, force_retry=request.force_retry
+                ))
+            except ClientDisconnected:
+                shutil.rmtree(track_dir, ignore_errors=True)
+                raise
+        
+        if not file_path:
+            # Cleanup
+            try:
+                shutil.rmtree(track_dir)
+            except:
+                pass
+            raise HTTPException(
+                status_code=404, 
+                detail=f"Não foi possível encontrar/baixar '{request.track_name}' no YouTube. A música pode estar bloqueada ou indisponível."
+            )
+        
+        # Schedule cleanup
+        def cleanup():
+            try:
+                shutil.rmtree(track_dir)
+            except:
+                pass
+        
+        background_tasks.add_task(cleanup)
+        
+        return FileResponse(
+            path=file_path,
+            filename=f"{filename}{file_path.suffix}",
+            media_type=AUDIO_MEDIA_TYPES.get(file_path.suffix, "application/octet-stream")
+        )
+    
+    except ClientDisconnected:
+        logging.info(f"🔌 Cliente desconectou, download cancelado: {request.track_name}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error downloading track: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao processar download")
+
+def attachment_header(filename: str) -> str:
+    """Content-Disposition value for a download, like FileResponse builds it"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+# Bytes read from ffmpeg per streamed chunk
+STREAM_CHUNK_SIZE = 64 * 1024
+
+@api_router.post("/download-track/stream")
+async def stream_track(request: DownloadRequest, http_request: Request):
+    """Download a single track, piping the audio to the client while it is fetched and converted"""
+    audio_format = request.audio_format()
+    filename = f"{request.track_name} - {request.track_artist}"
+    query = f"{request.track_name} {request.track_artist}"
+    not_found = HTTPException(
+        status_code=404,
+        detail=f"Não foi possível encontrar/baixar '{request.track_name}' no YouTube. A música pode estar bloqueada ou indisponível."
+    )
+    
+    loop = asyncio.get_event_loop()
+    cached = await loop.run_in_executor(cache_executor, audio_cache.lookup, request.track_id, audio_format.variant)
+    if cached:
+        cached_path = cached[0]
+        logging.info(f"⚡ Cache hit: {request.track_name}")
+        return FileResponse(
+            path=cached_path,
+            filename=f"{filename}{cached_path.suffix}",
+            media_type=AUDIO_MEDIA_TYPES.get(cached_path.suffix, "application/octet-stream")
+        )
+    
+    if not request.force_retry and unresolvable_tracks.contains(request.track_id, query):
+        logging.info(f"⏭ Pulando '{request.track_name}': falhou recentemente")
+        raise not_found
+    
+    # Both held until the stream ends, like a regular download
+    admitted = admission.admit(1, interactive=True)
+    try:
+        # Queued behind other downloads, a client that gives up must not still take a slot
+        await cancel_on_disconnect(http_request, download_scheduler.acquire(SlotTicket()))
+    except ClientDisconnected:
+        admitted.release()
+        logging.info(f"🔌 Cliente desconectou, download cancelado: {request.track_name}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except BaseException:
+        admitted.release()
+        raise
+    released = False
+    
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            download_scheduler.release()
+            admitted.release()
+    
+    resolved_video_id = None
+    
+    # Finding the stream and its first bytes get the same time budget as a regular download of the track
+    budget = TrackBudget.start()
+    
+    async def find_source():
+        nonlocal resolved_video_id
+        resolution = await get_resolution(request.track_id)
+        resolved_video_id = resolution['video_id'] if resolution else None
+        source = None
+        if resolved_video_id:
+            source = await fetch_stage.run(resolve_stream_source, [resolved_candidate(resolved_video_id)], audio_format,
+                                           budget)
+        if not source:
+            candidates = await search_stage.run(search_youtube, query, request.track_name, request.track_artist, None,
+                                                budget)
+            if candidates:
+                source = await fetch_stage.run(resolve_stream_source, candidates, audio_format, budget)
+        return source
+    
+    process = None
+    try:
+        source = await cancel_on_disconnect(http_request, find_source())
+        if not source:
+            track_failure(query, 'not_found')
+            unresolvable_tracks.add(request.track_id, query)
+            raise not_found
+        candidate, info = source
+        
+        output_args, ext = stream_output_args(audio_format, info)
+        headers = ''.join(f"{k}: {v}\r\n" for k, v in (info.get('http_headers') or {}).items())
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin',
+            '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+            # A stalled source fails the read instead of holding the slot for as long as the client waits
+            '-rw_timeout', str(int(YTDL_SOCKET_TIMEOUT * 1_000_000)),
+            '-headers', headers, '-i', info['url'],
+            '-vn', *output_args, 'pipe:1',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        
+        # Wait for the first bytes, so a source ffmpeg cannot read still gets a proper error
+        remaining = budget.remaining('download')
+        try:
+            first_chunk = await cancel_on_disconnect(http_request, asyncio.wait_for(
+                process.stdout.read(STREAM_CHUNK_SIZE), None if remaining == math.inf else remaining
+            ))
+        except asyncio.TimeoutError:
+            raise TrackDownloadError('timeout')
+        if not first_chunk:
+            _, stderr = await process.communicate()
+            logging.error(f"❌ ffmpeg falhou para '{request.track_name}': {stderr.decode(errors='replace').strip()}")
+            raise HTTPException(status_code=502, detail="Erro ao processar download")
+    except ClientDisconnected:
+        if process and process.returncode is None:
+            process.kill()
+            await process.wait()
+        release()
+        logging.info(f"🔌 Cliente desconectou, download cancelado: {request.track_name}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except TrackDownloadError as e:
+        if process and process.returncode is None:
+            process.kill()
+            await process.wait()
+        # Not remembered as unresolvable: the track may work once YouTube answers again
+        release()
+        track_failure(query, e.reason)
+        raise HTTPException(
+            status_code=503,
+            detail=f"Não foi possível baixar '{request.track_name}' agora. Tente novamente em instantes."
+        )
+    except HTTPException:
+        release()
+        raise
+    except Exception as e:
+        release()
+        logging.error(f"Error streaming track: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao processar download")
+    
+    # The streamed bytes are also written to disk, to feed the audio cache once complete
+    video_id = candidate['video']['id']
+    cache_file = DOWNLOAD_DIR / f"{uuid.uuid4().hex}{ext}"
+    
+    async def stream_audio():
+        complete = False
+        try:
+            with open(cache_file, 'wb') as f:
+                chunk = first_chunk
+                while chunk:
+                    f.write(chunk)
+                    yield chunk
+                    chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+            _, stderr = await process.communicate()
+            complete = process.returncode == 0
+            if not complete:
+                logging.error(f"❌ ffmpeg falhou para '{request.track_name}': {stderr.decode(errors='replace').strip()}")
+        finally:
+            # Give everything back before the first await: when the client goes away, Starlette
+            # cancels this generator from a cancel scope that also cancels every await in here
+            release()
+            if not complete:
+                cache_file.unlink(missing_ok=True)
+            # Client went away mid-stream: stop ffmpeg instead of letting it run to the end
+            if process.returncode is None:
+                process.kill()
+                with anyio.CancelScope(shield=True):
+                    await process.wait()
+            if complete:
+                logging.info(f"✅ Download concluído com sucesso!")
+                result = DownloadResult(
+                    path=cache_file,
+                    video_id=video_id,
+                    filename=yt_dlp.utils.sanitize_filename(f"{filename}{ext}"),
+                    strategy=candidate['strategy'],
+                    score=candidate['score'],
+                )
+                unresolvable_tracks.discard(request.track_id, query)
+                if video_id != resolved_video_id:
+                    await save_resolution(request.track_id, result)
+                await loop.run_in_executor(cache_executor, audio_cache.publish, request.track_id,
+                                           audio_format.variant, result)
+                cache_file.unlink(missing_ok=True)
+    
+    return StreamingResponse(
+        stream_audio(),
+        media_type=AUDIO_MEDIA_TYPES.get(ext, "application/octet-stream"),
+        headers={"Content-Disposition": attachment_header(f"{filename}{ext}")}
+    )
+
+@api_router.post("/download-all")
+async def download_all(request: DownloadAllRequest, background_tasks: BackgroundTasks, http_request: Request):
+    """Download all tracks and create a ZIP file"""
+    admitted = admission.admit(len(request.tracks))
+    try:
+        # Create unique directory for this download
+        download_id = str(uuid.uuid4())
+        zip_dir = DOWNLOAD_DIR / download_id
+        zip_dir.mkdir(exist_ok=True)
+        
+        concurrency = min(request.max_concurrency or BATCH_CONCURRENCY_PER_JOB, BATCH_CONCURRENCY_PER_JOB)
+        
+        # Download all tracks concurrently (continue even if some fail)
+        try:
+            results = await cancel_on_disconnect(http_request, download_tracks_concurrently(
+                request.tracks, zip_dir, concurrency, request.audio_format(), request.force_retry, admitted
+            ))
+        except ClientDisconnected:
+            shutil.rmtree(zip_dir, ignore_errors=True)
+            raise
+        
+        # Check if we have any downloads (results are in playlist order)
+        audio_files = [path for path in results if path]
+        successful_downloads = len(audio_files)
+        failed_tracks = [track.name for track, path in zip(request.tracks, results) if not path]
+        if not audio_files:
+            # Cleanup
+            try:
+                shutil.rmtree(zip_dir)
+            except:
+                pass
+            raise HTTPException(
+                status_code=404,
+                detail="Nenhuma música pôde ser baixada. Todas as músicas podem estar bloqueadas ou indisponíveis no YouTube."
+            )
+        
+        # Create ZIP file
+        zip_path = DOWNLOAD_DIR / f"{download_id}.zip"
+        # Compressing can take seconds for a big playlist: keep it off the event loop
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(executor, build_zip_archive, audio_files, zip_path)
+        
+        # Schedule cleanup
+        def cleanup():
+            try:
+                shutil.rmtree(zip_dir)
+                if zip_path.exists():
+                    zip_path.unlink()
+            except:
                 pass
         
         background_tasks.add_task(cleanup)
@@ -485,11 +3005,243 @@ async def download_all(request: DownloadAllRequest, background_tasks: Background
             }
         )
     
+    except ClientDisconnected:
+        logging.info(f"🔌 Cliente desconectou, download em lote cancelado: {request.playlist_id}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
     except HTTPException:
         raise
     except Exception as e:
         logging.error(f"Error downloading all tracks: {e}")
         raise HTTPException(status_code=500, detail="Erro ao processar download em lote")
+    finally:
+        admitted.release()
+
+@api_router.post("/sync")
+async def sync_playlist(request: SyncRequest, background_tasks: BackgroundTasks, http_request: Request):
+    """Download only the tracks added since the last sync, with a manifest of the removed ones"""
+    entry = await get_playlist_entry(request.playlist_id)
+    playlist = entry.response
+    state = None if request.reset else await load_sync_state(request.playlist_id, request.sync_id)
+    
+    delivered = {track['id']: track for track in state['tracks']} if state else {}
+    current_ids = {track.id for track in playlist.tracks}
+    added: Dict[str, Track] = {}
+    for track in playlist.tracks:
+        if track.id not in delivered and track.id not in added:
+            added[track.id] = track
+    removed = [track for track_id, track in delivered.items() if track_id not in current_ids]
+    new_tracks = list(added.values())
+    admitted = admission.admit(len(new_tracks)) if new_tracks else None
+    
+    download_id = str(uuid.uuid4())
+    zip_dir = DOWNLOAD_DIR / download_id
+    zip_dir.mkdir(exist_ok=True)
+    zip_path = DOWNLOAD_DIR / f"{download_id}.zip"
+    
+    def cleanup():
+        try:
+            shutil.rmtree(zip_dir)
+            if zip_path.exists():
+                zip_path.unlink()
+        except:
+            pass
+    
+    try:
+        if new_tracks:
+            concurrency = min(request.max_concurrency or BATCH_CONCURRENCY_PER_JOB, BATCH_CONCURRENCY_PER_JOB)
+            results = await cancel_on_disconnect(http_request, download_tracks_concurrently(
+                new_tracks, zip_dir, concurrency, request.audio_format(), request.force_retry, admitted
+            ))
+        else:
+            results = []
+        
+        audio_files = [path for path in results if path]
+        delivered_now = [track for track, path in zip(new_tracks, results) if path]
+        failed = [track for track, path in zip(new_tracks, results) if not path]
+        
+        as_entry = lambda track: {'id': track.id, 'name': track.name, 'artist': track.artist}
+        manifest = {
+            'playlist_id': request.playlist_id,
+            'snapshot_id': playlist.snapshot_id,
+            'previous_snapshot_id': state.get('snapshot_id') if state else None,
+            'added': [as_entry(track) for track in delivered_now],
+            'removed': removed,
+            # Not marked as delivered: the next sync tries them again
+            'failed': [as_entry(track) for track in failed],
+        }
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(executor, build_zip_archive, audio_files, zip_path, manifest)
+        
+        # Tracks still in the playlist stay delivered; the new ones join them
+        tracks_state = [track for track_id, track in delivered.items() if track_id in current_ids]
+        tracks_state.extend(as_entry(track) for track in delivered_now)
+    except ClientDisconnected:
+        # Nothing was delivered, so the sync state is left as it was
+        cleanup()
+        logging.info(f"🔌 Cliente desconectou, sincronização cancelada: {request.playlist_id}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except HTTPException:
+        cleanup()
+        raise
+    except Exception as e:
+        cleanup()
+        logging.error(f"Error syncing playlist: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao sincronizar playlist")
+    finally:
+        if admitted:
+            admitted.release()
+    
+    background_tasks.add_task(cleanup)
+    logging.info(f"Sync summary: {len(delivered_now)}/{len(new_tracks)} added, {len(removed)} removed. Failed: {[t.name for t in failed]}")
+    
+    # The new tracks only count as delivered once the client has the whole ZIP
+    return DeliveredFileResponse(
+        path=zip_path,
+        filename=f"{request.playlist_id}_sync.zip",
+        media_type="application/zip",
+        headers={
+            "X-Download-Summary": f"{len(delivered_now)}/{len(new_tracks)}",
+            "X-Sync-Removed": str(len(removed)),
+            "X-Failed-Tracks": ",".join(track.name for track in failed[:5])
+        },
+        on_delivery=BackgroundTask(save_sync_state, request.playlist_id, request.sync_id, playlist.snapshot_id,
+                                   tracks_state)
+    )
+
+@api_router.post("/download-all/stream")
+async def download_all_stream(request: DownloadAllRequest, http_request: Request):
+    """Download all tracks, streaming a ZIP that grows as each track finishes"""
+    admitted = admission.admit(len(request.tracks))
+    download_id = str(uuid.uuid4())
+    zip_dir = DOWNLOAD_DIR / download_id
+    zip_dir.mkdir(exist_ok=True)
+    
+    def cleanup():
+        try:
+            shutil.rmtree(zip_dir)
+        except:
+            pass
+    
+    concurrency = min(request.max_concurrency or BATCH_CONCURRENCY_PER_JOB, BATCH_CONCURRENCY_PER_JOB)
+    downloads = iter_track_downloads(request.tracks, zip_dir, concurrency, audio_format=request.audio_format(),
+                                     force_retry=request.force_retry, admitted=admitted)
+    failed_tracks = []
+    
+    # Hold the response until the first track is ready, so we can still answer 404 if nothing downloads
+    async def first_download() -> Optional[Path]:
+        async for idx, track, path in downloads:
+            if path:
+                return path
+            failed_tracks.append(track.name)
+        return None
+    
+    try:
+        first_path = await cancel_on_disconnect(http_request, first_download())
+    except ClientDisconnected:
+        await downloads.aclose()
+        cleanup()
+        logging.info(f"🔌 Cliente desconectou, download em lote cancelado: {request.playlist_id}")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except Exception as e:
+        await downloads.aclose()
+        cleanup()
+        logging.error(f"Error downloading all tracks: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao processar download em lote")
+    
+    if first_path is None:
+        cleanup()
+        raise HTTPException(
+            status_code=404,
+            detail="Nenhuma música pôde ser baixada. Todas as músicas podem estar bloqueadas ou indisponíveis no YouTube."
+        )
+    
+    async def stream_archive():
+        zip_stream = ZipStream()
+        successful_downloads = 0
+        
+        def add_track(path: Path):
+            yield from zip_stream.add_file(path, archive_name(path))
+            # Entry is in the archive now; don't keep the source around
+            path.unlink()
+        
+        try:
+            for data in add_track(first_path):
+                yield data
+            successful_downloads += 1
+            
+            async for idx, track, path in downloads:
+                if not path:
+                    failed_tracks.append(track.name)
+                    continue
+                for data in add_track(path):
+                    yield data
+                successful_downloads += 1
+            
+            yield zip_stream.close()
+            logging.info(f"Download summary: {successful_downloads}/{len(request.tracks)} successful. Failed: {failed_tracks}")
+        finally:
+            await downloads.aclose()
+            cleanup()
+    
+    return StreamingResponse(
+        stream_archive(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{request.playlist_id}_playlist.zip"'}
+    )
+
+@api_router.post("/jobs", response_model=JobCreatedResponse, status_code=202)
+async def create_download_job(request: DownloadAllRequest):
+    """Start a batch download in the background and return its job id right away"""
+    admitted = admission.admit(len(request.tracks))
+    job = DownloadJob(request)
+    job.admitted = admitted
+    jobs[job.id] = job
+    job.task = asyncio.create_task(run_download_job(job))
+    return JobCreatedResponse(job_id=job.id, status=job.status)
+
+@api_router.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_download_job(job_id: str):
+    """Get the status of a batch download job"""
+    return get_job(job_id).to_response()
+
+@api_router.get("/jobs/{job_id}/events")
+async def stream_download_job_events(job_id: str, last_event_id: Optional[str] = Header(default=None)):
+    """Server-Sent Events stream of job and per-track progress"""
+    job = get_job(job_id)
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+    
+    async def event_stream():
+        async for event in job.iter_events(start):
+            yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/jobs/{job_id}/artifact")
+async def get_download_job_artifact(job_id: str):
+    """Download the ZIP file produced by a finished job"""
+    job = get_job(job_id)
+    if job.status == 'failed':
+        raise HTTPException(
+            status_code=404,
+            detail="Nenhuma música pôde ser baixada. Todas as músicas podem estar bloqueadas ou indisponíveis no YouTube."
+        )
+    if job.status != 'completed' or not job.zip_path.exists():
+        raise HTTPException(status_code=409, detail="O download ainda está em andamento.")
+    
+    total = len(job.request.tracks)
+    return FileResponse(
+        path=job.zip_path,
+        filename=f"{job.request.playlist_id}_playlist.zip",
+        media_type="application/zip",
+        headers={
+            "X-Download-Summary": f"{job.successful_downloads}/{total}",
+            "X-Failed-Tracks": ",".join(job.failed_tracks[:5]) if job.failed_tracks else ""
+        }
+    )
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -509,6 +3261,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_db_indexes():
+    try:
+        await asyncio.wait_for(
+            track_resolutions.create_index('track_id', unique=True),
+            RESOLUTION_DB_TIMEOUT
+        )
+        await asyncio.wait_for(
+            playlist_syncs.create_index([('playlist_id', 1), ('sync_id', 1)], unique=True),
+            RESOLUTION_DB_TIMEOUT
+        )
+    except Exception as e:
+        logging.warning(f"⚠ Não foi possível criar índices no MongoDB: {e}")
+
+@app.on_event("startup")
+async def recover_audio_cache():
+    # Off the event loop: a large cache takes a while to scan
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, audio_cache.recover, AUDIO_CACHE_STALE_TMP)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+
+@app.on_event("shutdown")
+async def shutdown_spotify_client():
+    await spotify_api.aclose()
+
+@app.on_event("shutdown")
+async def shutdown_process_pool():
+    if process_pool:
+        process_pool.shutdown()
\ No newline at end of file
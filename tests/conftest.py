@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# server.py lives in backend/ and reads its settings at import time
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault('AUDIO_CACHE_DIR', tempfile.mkdtemp(prefix="spotify_cache_test_"))
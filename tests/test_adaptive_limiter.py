@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from server import AIMD_DECREASE, AdaptiveLimiter
+
+
+def test_limiter_paces_requests_after_the_burst():
+    limiter = AdaptiveLimiter('test', rate=20, burst=2, max_limit=4, backoff=1)
+    started = time.monotonic()
+    for _ in range(4):
+        assert limiter.acquire(1)
+        limiter.release('ok', time.monotonic())
+    # Two from the burst, two more at 20/s
+    assert time.monotonic() - started == pytest.approx(0.1, abs=0.05)
+
+
+def test_limiter_caps_requests_in_flight():
+    limiter = AdaptiveLimiter('test', rate=0, burst=1, max_limit=2, backoff=1)
+    assert limiter.acquire(0.1)
+    assert limiter.acquire(0.1)
+    assert not limiter.acquire(0.05)
+    limiter.release('ok', time.monotonic())
+    assert limiter.acquire(0.1)
+
+
+def test_limiter_cuts_limit_once_per_round():
+    limiter = AdaptiveLimiter('test', rate=0, burst=1, max_limit=8, backoff=1)
+    started = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    for _ in range(3):
+        limiter.release('error', started)
+    assert limiter.limit == 8 * AIMD_DECREASE
+    # A request started after the cut may cut again
+    limiter.acquire()
+    limiter.release('error', time.monotonic())
+    assert limiter.limit == 8 * AIMD_DECREASE ** 2
+
+
+def test_limiter_grows_back_up_to_its_ceiling():
+    limiter = AdaptiveLimiter('test', rate=0, burst=1, max_limit=2, backoff=1)
+    limiter.acquire()
+    limiter.release('error', time.monotonic())
+    assert limiter.limit == 1
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release('ok', time.monotonic())
+    assert limiter.limit == 2
+
+
+def test_limiter_pauses_after_a_throttle():
+    limiter = AdaptiveLimiter('test', rate=100, burst=5, max_limit=4, backoff=0.3)
+    limiter.acquire()
+    limiter.release('throttle', time.monotonic())
+    assert limiter.snapshot()['throttle'] == 1
+    assert not limiter.acquire(0.1)
+    started = time.monotonic()
+    assert limiter.acquire(1)
+    assert time.monotonic() - started == pytest.approx(0.2, abs=0.1)
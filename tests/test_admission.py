@@ -0,0 +1,45 @@
+import pytest
+from fastapi import HTTPException
+
+from server import AdmissionController
+
+
+def retry_after(controller: AdmissionController, tracks: int, interactive: bool = False) -> int:
+    with pytest.raises(HTTPException) as excinfo:
+        controller.admit(tracks, interactive=interactive)
+    assert excinfo.value.status_code == 429
+    return int(excinfo.value.headers['Retry-After'])
+
+
+def test_admission_retry_after_is_time_to_drain_the_excess():
+    controller = AdmissionController(max_batch_tracks=10, max_interactive=2, slots=2, initial_track_seconds=30)
+    controller.admit(8)
+    # 3 tracks over the limit, 30s each over 2 slots
+    assert retry_after(controller, 5) == 45
+    assert controller.batch == 8
+
+
+def test_admission_idle_server_takes_any_playlist():
+    controller = AdmissionController(max_batch_tracks=10, max_interactive=2, slots=2, initial_track_seconds=30)
+    ticket = controller.admit(100)
+    assert not controller.accepting
+    ticket.done(95)
+    assert controller.batch == 5
+    ticket.release()
+    assert controller.batch == 0
+
+
+def test_admission_interactive_limit_is_separate():
+    controller = AdmissionController(max_batch_tracks=1, max_interactive=2, slots=2, initial_track_seconds=30)
+    controller.admit(5)
+    controller.admit(1, interactive=True)
+    controller.admit(1, interactive=True)
+    assert retry_after(controller, 1, interactive=True) == 15
+
+
+def test_admission_retry_after_follows_track_durations():
+    controller = AdmissionController(max_batch_tracks=1, max_interactive=1, slots=1, initial_track_seconds=30)
+    controller.observe(130)
+    assert controller.track_seconds == pytest.approx(40)
+    controller.admit(1, interactive=True)
+    assert retry_after(controller, 1, interactive=True) == 40
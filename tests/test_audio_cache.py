@@ -0,0 +1,83 @@
+import os
+import time
+
+from server import AudioCache, DownloadResult
+
+
+def download(tmp_path, video_id: str, size: int) -> DownloadResult:
+    path = tmp_path / f"{video_id}.mp3"
+    path.write_bytes(b'x' * size)
+    return DownloadResult(path=path, video_id=video_id, filename=f"{video_id} song.mp3", strategy='busca principal')
+
+
+def make_cache(tmp_path, max_bytes: int) -> AudioCache:
+    cache = AudioCache(tmp_path / "cache", max_bytes)
+    cache.recover(stale_after=3600)
+    return cache
+
+
+def age(cache: AudioCache, video_id: str, seconds: float):
+    """Make a cached object look last used `seconds` ago"""
+    for path in cache.objects_dir.glob(f"{video_id}.*"):
+        then = time.time() - seconds
+        os.utime(path, (then, then))
+
+
+def test_publish_then_lookup_by_track_and_video(tmp_path):
+    cache = make_cache(tmp_path, 10_000)
+    cache.publish('track1', 'mp3-192', download(tmp_path, 'vid1', 10))
+
+    path, filename = cache.lookup('track1', 'mp3-192')
+    assert path.read_bytes() == b'x' * 10
+    assert filename == "vid1 song.mp3"
+    assert cache.lookup_video('vid1', 'mp3-192') == path
+    assert cache.lookup('track1', 'native') is None
+    assert cache.lookup('../track1', 'mp3-192') is None
+
+
+def test_tracks_share_the_audio_of_one_video(tmp_path):
+    cache = make_cache(tmp_path, 10_000)
+    cache.publish('single', 'mp3-192', download(tmp_path, 'vid1', 10))
+    cache.link_track('album', 'mp3-192', 'vid1', "album version.mp3")
+
+    assert cache.lookup('album', 'mp3-192') == (cache.lookup('single', 'mp3-192')[0], "album version.mp3")
+    assert len(list(cache.objects_dir.iterdir())) == 1
+
+
+def test_eviction_drops_least_recently_used_down_to_low_water(tmp_path):
+    cache = make_cache(tmp_path, 100)
+    for index, video_id in enumerate(['oldest', 'old', 'used', 'new']):
+        cache.publish(video_id, 'mp3-192', download(tmp_path, video_id, 25))
+        age(cache, video_id, 100 - index)
+    assert cache.lookup('used', 'mp3-192')  # a hit makes it the most recent
+
+    cache.publish('last', 'mp3-192', download(tmp_path, 'last', 25))
+
+    # 125 bytes over a limit of 100: trimmed to at most 90 (LOW_WATER), least recently used first
+    assert cache.lookup('oldest', 'mp3-192') is None
+    assert cache.lookup('old', 'mp3-192') is None
+    for video_id in ['used', 'new', 'last']:
+        assert cache.lookup(video_id, 'mp3-192') is not None
+    assert cache._size == 75
+
+
+def test_recover_keeps_recent_temp_files(tmp_path):
+    cache = AudioCache(tmp_path / "cache", 10_000)
+    (cache.objects_dir / "vid1.mp3-192.mp3").write_bytes(b'x' * 10)
+    temp = cache.objects_dir / ".publishing.tmp"
+    temp.write_bytes(b'x')
+
+    cache.recover(stale_after=3600)
+    assert temp.exists()
+    assert cache._size == 10
+
+    cache.recover(stale_after=0)
+    assert not temp.exists()
+
+
+def test_failed_pointer_write_does_not_raise(tmp_path):
+    cache = make_cache(tmp_path, 10_000)
+    cache.tracks_dir.rmdir()
+
+    cache.link_track('track1', 'mp3-192', 'vid1', "song.mp3")
+    assert cache.lookup('track1', 'mp3-192') is None
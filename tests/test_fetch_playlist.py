@@ -0,0 +1,49 @@
+import asyncio
+
+import server
+
+
+def fake_spotify(monkeypatch, total: int, first_page_size: int) -> list:
+    """Serve a playlist of `total` numbered items; returns the offsets of the page requests"""
+    offsets = []
+
+    async def get(path, params=None):
+        if not path.endswith('/tracks'):
+            items = [{'n': n} for n in range(min(first_page_size, total))]
+            return {'id': 'pl', 'tracks': {'items': items, 'total': total}}
+        offset = params['offset']
+        offsets.append(offset)
+        # Later pages answer first, the items must still come back in playlist order
+        await asyncio.sleep(0.01 * (total - offset) / server.SPOTIFY_PAGE_SIZE)
+        end = min(offset + params['limit'], total)
+        return {'items': [{'n': n} for n in range(offset, end)]}
+
+    monkeypatch.setattr(server.spotify_api, 'get', get)
+    return offsets
+
+
+def test_pages_fetched_from_the_total_in_playlist_order(monkeypatch):
+    offsets = fake_spotify(monkeypatch, total=250, first_page_size=100)
+
+    playlist, items = asyncio.run(server.fetch_playlist('pl'))
+
+    assert sorted(offsets) == [100, 200]
+    assert [item['n'] for item in items] == list(range(250))
+
+
+def test_single_page_playlist_makes_one_request(monkeypatch):
+    offsets = fake_spotify(monkeypatch, total=40, first_page_size=100)
+
+    playlist, items = asyncio.run(server.fetch_playlist('pl'))
+
+    assert offsets == []
+    assert len(items) == 40
+
+
+def test_empty_first_page_does_not_request_more(monkeypatch):
+    offsets = fake_spotify(monkeypatch, total=5, first_page_size=0)
+
+    playlist, items = asyncio.run(server.fetch_playlist('pl'))
+
+    assert offsets == []
+    assert items == []
@@ -0,0 +1,38 @@
+import time
+
+from server import NegativeCache
+
+
+def test_negative_cache_matches_track_id_and_query():
+    cache = NegativeCache(ttl=60, max_entries=10)
+    cache.add('t1', 'Song Artist')
+    assert cache.contains('t1', 'Other Song')
+    # The same song under another track id
+    assert cache.contains('t2', 'song artist')
+    assert not cache.contains('t3', 'Other Song')
+
+
+def test_negative_cache_entries_expire():
+    cache = NegativeCache(ttl=0.05, max_entries=10)
+    cache.add('t1', 'Song Artist')
+    time.sleep(0.1)
+    assert not cache.contains('t1', 'Song Artist')
+    assert not cache._expiry
+
+
+def test_negative_cache_drops_oldest_entries_when_full():
+    cache = NegativeCache(ttl=60, max_entries=2)
+    cache.add('t1', 'First')
+    cache.add('t2', 'Second')
+    assert not cache.contains('t1', 'First')
+    assert cache.contains('t2', 'Second')
+
+
+def test_negative_cache_discard_and_disabled():
+    cache = NegativeCache(ttl=60, max_entries=10)
+    cache.add('t1', 'Song')
+    cache.discard('t1', 'Song')
+    assert not cache.contains('t1', 'Song')
+    disabled = NegativeCache(ttl=0, max_entries=10)
+    disabled.add('t1', 'Song')
+    assert not disabled.contains('t1', 'Song')
@@ -0,0 +1,25 @@
+import logging
+
+from server import AudioFormat, stream_output_args
+
+
+def test_matching_codec_is_copied(caplog):
+    with caplog.at_level(logging.WARNING):
+        args, ext = stream_output_args(AudioFormat('opus'), {'acodec': 'opus', 'ext': 'webm'})
+        assert args[:2] == ['-c:a', 'copy'] and ext == '.opus'
+        args, ext = stream_output_args(AudioFormat('m4a'), {'acodec': 'mp4a.40.2', 'ext': 'm4a'}, seekable=True)
+        assert args[:2] == ['-c:a', 'copy'] and ext == '.m4a'
+        assert '+faststart' in args
+    assert not caplog.records
+
+
+def test_fallback_stream_is_re_encoded_with_a_warning(caplog):
+    with caplog.at_level(logging.WARNING):
+        args, ext = stream_output_args(AudioFormat('m4a'), {'acodec': 'opus', 'ext': 'webm'})
+    assert args[:2] == ['-c:a', 'aac'] and ext == '.m4a'
+    assert 'recodificando' in caplog.text
+
+
+def test_mp3_always_re_encodes_at_the_bitrate():
+    args, ext = stream_output_args(AudioFormat('mp3', 256), {'acodec': 'mp3'})
+    assert args[:4] == ['-c:a', 'libmp3lame', '-b:a', '256k'] and ext == '.mp3'
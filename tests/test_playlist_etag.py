@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+import server
+from fastapi.testclient import TestClient
+
+
+def test_etag_matches():
+    etag = '"snap1"'
+    assert server.etag_matches('"snap1"', etag)
+    assert server.etag_matches('*', etag)
+    assert server.etag_matches('"old", W/"snap1"', etag)
+    assert not server.etag_matches('"old"', etag)
+    assert not server.etag_matches('snap1', etag)
+    assert not server.etag_matches(None, etag)
+    assert not server.etag_matches('', etag)
+
+
+def fake_playlist(monkeypatch, snapshot_id: str) -> list:
+    """Serve a one-track playlist from a fake Spotify; returns the fetches made"""
+    fetches = []
+    item = {'track': {'id': 't1', 'name': 'Song', 'duration_ms': 1000, 'artists': [{'name': 'Artist'}],
+                      'album': {'name': 'Album', 'images': []}}}
+
+    async def fetch(playlist_id):
+        fetches.append(playlist_id)
+        return {'id': playlist_id, 'name': 'Playlist', 'snapshot_id': snapshot_id}, [item]
+
+    monkeypatch.setattr(server, 'playlist_cache', OrderedDict())
+    monkeypatch.setattr(server, 'fetch_playlist', fetch)
+    return fetches
+
+
+def test_unchanged_playlist_answers_304(monkeypatch):
+    fetches = fake_playlist(monkeypatch, 'snap1')
+    client = TestClient(server.app)
+
+    first = client.get('/api/playlist/abc')
+    assert first.status_code == 200
+    assert first.headers['etag'] == '"snap1"'
+    assert first.json()['tracks'][0]['id'] == 't1'
+
+    again = client.get('/api/playlist/abc', headers={'If-None-Match': '"snap1"'})
+    assert again.status_code == 304
+    assert again.headers['etag'] == '"snap1"'
+    assert again.content == b''
+    assert fetches == ['abc']
+
+
+def test_stale_etag_gets_the_playlist(monkeypatch):
+    fake_playlist(monkeypatch, 'snap2')
+
+    response = TestClient(server.app).post('/api/playlist', json={'url': 'https://open.spotify.com/playlist/abc'},
+                                           headers={'If-None-Match': '"snap1"'})
+
+    assert response.status_code == 200
+    assert response.headers['etag'] == '"snap2"'
+    assert response.json()['snapshot_id'] == 'snap2'
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+
+from server import AdaptiveLimiter, DownloadScheduler, PipelineStage, SlotTicket
+
+
+async def grant_order(scheduler: DownloadScheduler, tickets: dict) -> list:
+    """Queue the tickets behind a held slot, then release it once per grant"""
+    granted = []
+
+    async def wait(name, ticket):
+        await scheduler.acquire(ticket)
+        granted.append(name)
+
+    await scheduler.acquire(SlotTicket())
+    tasks = []
+    for name, ticket in tickets.items():
+        tasks.append(asyncio.ensure_future(wait(name, ticket)))
+        await asyncio.sleep(0)
+    for _ in tickets:
+        scheduler.release()
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return granted
+
+
+def test_scheduler_serves_interactive_first_then_jobs_in_turn():
+    scheduler = DownloadScheduler(1)
+    tickets = {
+        'A1': SlotTicket(group='A'),
+        'A2': SlotTicket(group='A'),
+        'B1': SlotTicket(group='B'),
+        'interactive': SlotTicket(),
+    }
+    assert asyncio.run(grant_order(scheduler, tickets)) == ['interactive', 'A1', 'B1', 'A2']
+
+
+def test_scheduler_promote_moves_batch_ticket_ahead():
+    scheduler = DownloadScheduler(1)
+    first, promoted = SlotTicket(group='A'), SlotTicket(group='B')
+
+    async def run():
+        await scheduler.acquire(SlotTicket())
+        waiters = [asyncio.ensure_future(scheduler.acquire(ticket)) for ticket in (first, promoted)]
+        await asyncio.sleep(0)
+        scheduler.promote(promoted)
+        scheduler.release()
+        await asyncio.sleep(0)
+        return [waiter.done() for waiter in waiters]
+
+    assert asyncio.run(run()) == [False, True]
+    assert promoted.interactive
+
+
+def test_scheduler_cancelled_waiter_does_not_leak_slot():
+    scheduler = DownloadScheduler(1)
+
+    async def run():
+        await scheduler.acquire(SlotTicket())
+        waiter = asyncio.ensure_future(scheduler.acquire(SlotTicket(group='A')))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release()
+
+    asyncio.run(run())
+    assert scheduler.free == 1
+    assert scheduler.waiting == 0
+
+
+def test_scheduler_slot_granted_while_cancelled_is_handed_on():
+    scheduler = DownloadScheduler(1)
+
+    async def run():
+        await scheduler.acquire(SlotTicket())
+        first = asyncio.ensure_future(scheduler.acquire(SlotTicket()))
+        second = asyncio.ensure_future(scheduler.acquire(SlotTicket()))
+        await asyncio.sleep(0)
+        # Grant the slot to the first waiter and cancel it before it runs
+        scheduler.release()
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.wait_for(second, 1)
+
+    asyncio.run(run())
+    assert scheduler.free == 0
+
+
+def test_stage_runs_interactive_work_before_queued_batch_work():
+    stage = PipelineStage("test", 1)
+    gate = threading.Event()
+    ran = []
+
+    def work(name):
+        if name == 'first':
+            gate.wait(5)
+        ran.append(name)
+
+    async def run():
+        calls = [asyncio.ensure_future(stage.run(work, 'first', ticket=SlotTicket(group='A')))]
+        await asyncio.sleep(0.05)
+        calls.append(asyncio.ensure_future(stage.run(work, 'batch', ticket=SlotTicket(group='B'))))
+        await asyncio.sleep(0)
+        calls.append(asyncio.ensure_future(stage.run(work, 'interactive', ticket=SlotTicket())))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(*calls)
+
+    asyncio.run(run())
+    assert ran == ['first', 'interactive', 'batch']
+    assert stage.free == 1
+
+
+def test_stage_keeps_worker_taken_until_a_cancelled_call_ends():
+    stage = PipelineStage("test", 1)
+    gate = threading.Event()
+
+    async def run():
+        call = asyncio.ensure_future(stage.run(gate.wait, 5))
+        await asyncio.sleep(0.05)
+        call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+        taken = stage.free
+        gate.set()
+        await asyncio.sleep(0.05)
+        return taken
+
+    assert asyncio.run(run()) == 0
+    assert stage.free == 1
+
+
+def test_limiter_serves_interactive_requests_first():
+    limiter = AdaptiveLimiter('test', rate=0, burst=1, max_limit=1, backoff=1)
+    limiter.acquire()
+    granted = []
+
+    def wait(name, interactive):
+        limiter.acquire(2, interactive=interactive)
+        granted.append(name)
+        limiter.release('ok', time.monotonic())
+
+    batch = threading.Thread(target=wait, args=('batch', False))
+    batch.start()
+    time.sleep(0.05)
+    interactive = threading.Thread(target=wait, args=('interactive', True))
+    interactive.start()
+    time.sleep(0.05)
+    limiter.release('ok', time.monotonic())
+    batch.join()
+    interactive.join()
+    assert granted == ['interactive', 'batch']
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from server import SpotifyAPI, SpotifyAPIError, SpotifyGovernor, parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after('0.5') == 0.5
+    assert parse_retry_after('-2') == 0.0
+    assert parse_retry_after(None) == 1.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', default=2.0) == 2.0
+
+
+def test_throttled_governor_waits_for_retry_after():
+    governor = SpotifyGovernor(rate=0, burst=1, max_wait=5)
+
+    async def run():
+        governor.throttled(0.2)
+        start = time.monotonic()
+        await governor.acquire(start + 5)
+        return time.monotonic() - start
+
+    assert 0.15 <= asyncio.run(run()) < 1
+
+
+def test_governor_gives_429_once_max_wait_would_be_exceeded():
+    governor = SpotifyGovernor(rate=0, burst=1, max_wait=1)
+
+    async def run():
+        governor.throttled(30)
+        start = time.monotonic()
+        with pytest.raises(SpotifyAPIError) as error:
+            await governor.acquire(start + governor.max_wait)
+        return error.value, time.monotonic() - start
+
+    error, waited = asyncio.run(run())
+    assert error.status == 429
+    assert error.retry_after > 29
+    assert waited < 0.5  # fails right away instead of sleeping up to the deadline
+
+
+def test_governor_paces_calls_at_its_rate():
+    governor = SpotifyGovernor(rate=20, burst=1, max_wait=5)
+
+    async def run():
+        start = time.monotonic()
+        for _ in range(3):
+            await governor.acquire(start + 5)
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.09
+
+
+def fake_api(responses: list, max_wait: float) -> SpotifyAPI:
+    """SpotifyAPI with a valid token whose HTTP calls get `responses` in turn"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return responses.pop(0)
+
+    api = SpotifyAPI(None, None, None, 1, 5, SpotifyGovernor(rate=0, burst=1, max_wait=max_wait))
+    api.http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    api._token = {'access_token': 'token', 'expires_at': time.time() + 3600}
+    api.requests = requests
+    return api
+
+
+def test_api_retries_after_a_429_with_retry_after():
+    api = fake_api([
+        httpx.Response(429, headers={'Retry-After': '0.2'}),
+        httpx.Response(200, json={'id': 'pl'}),
+    ], max_wait=5)
+
+    async def run():
+        start = time.monotonic()
+        result = await api.get('/playlists/pl')
+        return result, time.monotonic() - start
+
+    result, waited = asyncio.run(run())
+    assert result == {'id': 'pl'}
+    assert len(api.requests) == 2
+    assert waited >= 0.15
+
+
+def test_api_gives_up_when_retry_after_exceeds_max_wait():
+    api = fake_api([httpx.Response(429, headers={'Retry-After': '60'})], max_wait=1)
+
+    with pytest.raises(SpotifyAPIError) as error:
+        asyncio.run(api.get('/playlists/pl'))
+
+    assert error.value.status == 429
+    assert len(api.requests) == 1
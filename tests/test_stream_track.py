@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import stat
+import sys
+
+import server
+from fastapi.testclient import TestClient
+
+FAKE_FFMPEG = """#!{python}
+import sys, time
+open(sys.argv[0] + '.args', 'w').write(' '.join(sys.argv[1:]))
+if {stalled}:
+    time.sleep(60)
+while True:
+    sys.stdout.buffer.write(b'x' * 65536)
+    sys.stdout.buffer.flush()
+    time.sleep(0.01)
+"""
+
+
+def fake_source(monkeypatch, tmp_path, stalled: bool = False):
+    """Find any track on a fake video and stream it with an ffmpeg that never ends (or never starts)"""
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(FAKE_FFMPEG.format(python=sys.executable, stalled=stalled))
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    async def no_resolution(track_id):
+        return None
+
+    candidate = {'video': {'id': 'vid'}, 'strategy': 'busca principal', 'score': 50.0}
+    monkeypatch.setattr(server, 'get_resolution', no_resolution)
+    monkeypatch.setattr(server, 'search_youtube', lambda *args: [candidate])
+    monkeypatch.setattr(server, 'resolve_stream_source',
+                        lambda *args: (candidate, {'url': 'http://example.invalid/audio', 'ext': 'webm'}))
+
+
+async def stream_then_disconnect(chunks: int) -> int:
+    """POST to the stream endpoint and go away after `chunks` body chunks; returns the chunks sent"""
+    body = json.dumps({'track_id': 'stream-test', 'track_name': 'Song', 'track_artist': 'Artist'}).encode()
+    enough_sent = asyncio.Event()
+    sent = 0
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await enough_sent.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal sent
+        if message['type'] == 'http.response.body' and message.get('body'):
+            sent += 1
+            if sent >= chunks:
+                enough_sent.set()
+
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': '/api/download-track/stream', 'raw_path': b'/api/download-track/stream',
+        'query_string': b'', 'root_path': '', 'headers': [(b'content-type', b'application/json')],
+        'client': ('127.0.0.1', 1234), 'server': ('testserver', 80),
+    }
+    await asyncio.wait_for(server.app(scope, receive, send), 10)
+    return sent
+
+
+def test_stream_disconnect_gives_back_slot_and_admission(monkeypatch, tmp_path):
+    fake_source(monkeypatch, tmp_path)
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    monkeypatch.setattr(server, 'DOWNLOAD_DIR', downloads)
+    free = server.download_scheduler.free
+
+    assert asyncio.run(stream_then_disconnect(3)) >= 3
+
+    assert server.download_scheduler.free == free
+    assert server.admission.interactive == 0
+    assert not list(downloads.iterdir())
+
+
+class ShortBudget(server.TrackBudget):
+    @classmethod
+    def start(cls, total: float = 0.5) -> server.TrackBudget:
+        return super().start(total)
+
+
+def test_stalled_stream_source_times_out(monkeypatch, tmp_path):
+    fake_source(monkeypatch, tmp_path, stalled=True)
+    monkeypatch.setattr(server, 'TrackBudget', ShortBudget)
+    free = server.download_scheduler.free
+
+    response = TestClient(server.app).post('/api/download-track/stream',
+                                           json={'track_id': 'stalled-test', 'track_name': 'Song', 'track_artist': 'Artist'})
+
+    assert response.status_code == 503
+    assert server.download_scheduler.free == free
+    assert '-rw_timeout' in (tmp_path / "ffmpeg.args").read_text()
@@ -0,0 +1,86 @@
+import io
+import json
+import zipfile
+from collections import OrderedDict
+
+import server
+from fastapi.testclient import TestClient
+
+
+def spotify_item(track_id: str) -> dict:
+    return {'track': {'id': track_id, 'name': f"Song {track_id}", 'duration_ms': 1000,
+                      'artists': [{'name': 'Artist'}], 'album': {'name': 'Album', 'images': []}}}
+
+
+def fake_sync(monkeypatch, tmp_path, playlist_ids: list, delivered_ids: list, failing: set) -> dict:
+    """Fake Spotify, the sync state store and the downloads; returns what gets stored and downloaded"""
+    stored = {}
+
+    async def fetch(playlist_id):
+        playlist = {'id': playlist_id, 'name': 'Playlist', 'snapshot_id': 'snap2'}
+        return playlist, [spotify_item(track_id) for track_id in playlist_ids]
+
+    async def load_state(playlist_id, sync_id):
+        delivered = [{'id': track_id, 'name': f"Song {track_id}", 'artist': 'Artist'} for track_id in delivered_ids]
+        return {'snapshot_id': 'snap1', 'tracks': delivered}
+
+    async def save_state(playlist_id, sync_id, snapshot_id, tracks):
+        stored.update(snapshot_id=snapshot_id, tracks=[track['id'] for track in tracks])
+
+    async def download(tracks, output_dir, concurrency, audio_format, force_retry, admitted):
+        stored['downloaded'] = [track.id for track in tracks]
+        results = []
+        for track in tracks:
+            path = output_dir / f"{track.id}.mp3"
+            if track.id not in failing:
+                path.write_bytes(b'audio')
+            results.append(None if track.id in failing else path)
+        return results
+
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    monkeypatch.setattr(server, 'DOWNLOAD_DIR', downloads)
+    monkeypatch.setattr(server, 'playlist_cache', OrderedDict())
+    monkeypatch.setattr(server, 'fetch_playlist', fetch)
+    monkeypatch.setattr(server, 'load_sync_state', load_state)
+    monkeypatch.setattr(server, 'save_sync_state', save_state)
+    monkeypatch.setattr(server, 'download_tracks_concurrently', download)
+    return stored
+
+
+def test_sync_sends_only_the_delta_with_a_manifest(monkeypatch, tmp_path):
+    stored = fake_sync(monkeypatch, tmp_path, playlist_ids=['kept', 'new', 'broken'],
+                       delivered_ids=['kept', 'gone'], failing={'broken'})
+
+    response = TestClient(server.app).post('/api/sync', json={'playlist_id': 'abc'})
+
+    assert response.status_code == 200
+    assert response.headers['x-download-summary'] == '1/2'
+    assert response.headers['x-sync-removed'] == '1'
+    assert stored['downloaded'] == ['new', 'broken']
+
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    manifest = json.loads(archive.read('manifest.json'))
+    assert manifest['previous_snapshot_id'] == 'snap1'
+    assert manifest['snapshot_id'] == 'snap2'
+    assert [track['id'] for track in manifest['added']] == ['new']
+    assert [track['id'] for track in manifest['removed']] == ['gone']
+    assert [track['id'] for track in manifest['failed']] == ['broken']
+    assert len(archive.namelist()) == 2
+
+    # Failed tracks stay out of the state so the next sync retries them
+    assert stored['snapshot_id'] == 'snap2'
+    assert stored['tracks'] == ['kept', 'new']
+
+
+def test_reset_sync_sends_every_track(monkeypatch, tmp_path):
+    stored = fake_sync(monkeypatch, tmp_path, playlist_ids=['kept', 'new'], delivered_ids=['kept'], failing=set())
+
+    response = TestClient(server.app).post('/api/sync', json={'playlist_id': 'abc', 'reset': True})
+
+    assert response.status_code == 200
+    assert stored['downloaded'] == ['kept', 'new']
+    manifest = json.loads(zipfile.ZipFile(io.BytesIO(response.content)).read('manifest.json'))
+    assert manifest['previous_snapshot_id'] is None
+    assert manifest['removed'] == []
+    assert stored['tracks'] == ['kept', 'new']
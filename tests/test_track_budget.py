@@ -0,0 +1,27 @@
+import math
+import time
+
+import pytest
+
+from server import TrackBudget
+
+
+def test_budget_reserves_time_for_later_phases():
+    budget = TrackBudget.start(10)
+    assert budget.remaining('search') == pytest.approx(2.5, abs=0.1)
+    assert budget.remaining('download') == pytest.approx(8, abs=0.1)
+    assert budget.remaining('transcode') == pytest.approx(10, abs=0.1)
+    assert budget.remaining() == pytest.approx(10, abs=0.1)
+
+
+def test_budget_past_deadline_is_exhausted():
+    budget = TrackBudget(time.monotonic() - 1, 10)
+    assert budget.remaining() == 0
+    assert budget.exhausted('transcode')
+    assert budget.exhausted('search')
+
+
+def test_budget_disabled_never_runs_out():
+    budget = TrackBudget.start(0)
+    assert budget.remaining('search') == math.inf
+    assert not budget.exhausted()
@@ -0,0 +1,66 @@
+import asyncio
+
+import server
+
+
+def fake_resolve(monkeypatch, tmp_path) -> list:
+    """Resolve every track to a small file after a short wait; returns the calls made"""
+    calls = []
+    monkeypatch.setattr(server, 'DOWNLOAD_DIR', tmp_path)
+
+    async def resolve(track_id, track_name, track_artist, work_dir, ticket, progress, audio_format, cancelled):
+        calls.append((track_id, cancelled))
+        await asyncio.sleep(0.05)
+        work_dir.mkdir()
+        path = work_dir / "song.mp3"
+        path.write_bytes(b'audio')
+        return path, "Song.mp3"
+
+    monkeypatch.setattr(server, 'resolve_track', resolve)
+    return calls
+
+
+def test_concurrent_calls_share_one_download(monkeypatch, tmp_path):
+    calls = fake_resolve(monkeypatch, tmp_path)
+    outputs = [tmp_path / "out1", tmp_path / "out2"]
+    for output in outputs:
+        output.mkdir()
+
+    async def run():
+        return await asyncio.gather(*(
+            server.fetch_track('flight-shared', 'Song', 'Artist', output) for output in outputs
+        ))
+
+    first, second = asyncio.run(run())
+    assert len(calls) == 1
+    assert first != second
+    assert first.read_bytes() == second.read_bytes() == b'audio'
+    assert not server.track_flights
+
+
+def test_download_cancelled_once_the_last_waiter_leaves(monkeypatch, tmp_path):
+    calls = fake_resolve(monkeypatch, tmp_path)
+
+    async def run():
+        waiters = [asyncio.ensure_future(server.fetch_track('flight-cancel', 'Song', 'Artist', tmp_path))
+                   for _ in range(2)]
+        key = ('flight-cancel', server.DEFAULT_AUDIO_FORMAT.variant)
+        while len(calls) < 1 or server.track_flights[key].waiters < 2:
+            await asyncio.sleep(0.001)
+        flight = server.track_flights[key]
+
+        waiters[0].cancel()
+        await asyncio.gather(waiters[0], return_exceptions=True)
+        still_running = not flight.task.done()
+
+        waiters[1].cancel()
+        await asyncio.gather(waiters[1], return_exceptions=True)
+        await asyncio.gather(flight.task, return_exceptions=True)
+        return still_running, flight
+
+    still_running, flight = asyncio.run(run())
+    assert still_running
+    assert flight.task.cancelled()
+    assert flight.cancelled.is_set()
+    assert len(calls) == 1
+    assert not server.track_flights
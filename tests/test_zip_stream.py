@@ -0,0 +1,21 @@
+import io
+import zipfile
+
+from server import ZipStream
+
+
+def test_zip_stream_builds_a_valid_archive(tmp_path):
+    first = tmp_path / "a.mp3"
+    first.write_bytes(b'a' * (ZipStream.CHUNK_SIZE * 2 + 5))
+    second = tmp_path / "b.mp3"
+    second.write_bytes(b'b' * 10)
+
+    archive = ZipStream()
+    data = b''.join([*archive.add_file(first, "song.mp3"), *archive.add_file(second, "song.mp3"), archive.close()])
+
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ["song.mp3", "song (2).mp3"]
+        assert z.read("song.mp3") == first.read_bytes()
+        assert z.read("song (2).mp3") == second.read_bytes()
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in z.infolist())